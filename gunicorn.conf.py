@@ -0,0 +1,22 @@
+# gunicorn.conf.py — production entry point for server.py
+# Run:  WEB_CONCURRENCY=4 PORT=5000 ... gunicorn -c gunicorn.conf.py server:app   (or: python server.py serve)
+# Workers are separate processes; they share caches through SHARED_CACHE_PATH (SQLite, WAL).
+import os
+
+bind         = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers      = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+worker_class = "gthread"  # upstream calls are blocking `requests`; threads keep each worker busy
+threads      = int(os.environ.get("GUNICORN_THREADS", "16"))  # each open /subscribe stream holds one;
+                                                               # server.py caps streams at threads // 4 by default
+timeout      = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+preload_app  = False      # each worker opens its own sqlite/memmap handles
+
+os.environ.setdefault("SHARED_CACHE_PATH", "/tmp/kai_cache.sqlite3")
+
+def on_starting(server):
+    # Start each deployment with an empty cache; the first worker to touch it recreates the table
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(os.environ["SHARED_CACHE_PATH"] + suffix)
+        except FileNotFoundError:
+            pass
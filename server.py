@@ -1,17 +1,37 @@
 # server.py — Flask backend for Kai (chat + TTS + Google CSE + state + auto-search + time/weather intents)
 # Run:  PORT=5000 API_KEY_VALUE=... OPENAI_API_KEY=... GOOGLE_API_KEY=... GOOGLE_CSE_ID=...
 #       FB_ROOT=... ELEVEN_API_KEY=...  python server.py
+# Prod: WEB_CONCURRENCY=4 ... python server.py serve   (gunicorn workers + shared host cache)
 
-import os, json, base64, traceback, re
+import os, sys, json, time, zlib, gzip, hmac, heapq, queue, base64, sqlite3, hashlib, threading, traceback, re
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
 from urllib.parse import urlencode
 
 import requests
-from flask import Flask, request, jsonify, send_file, make_response
+from flask import Flask, Response, request, jsonify, send_file, make_response, g
 from flask_cors import CORS
 from openai import OpenAI
 
+try:
+    import numpy as np
+except ImportError:  # only the replay engine and long-term memory need numpy
+    np = None
+
+try:
+    import fcntl
+except ImportError:  # Windows dev box: single process, thread locks are enough
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # responses fall back to gzip
+    brotli = None
+
 # ---------- Config ----------
 FB_ROOT = os.getenv("FB_ROOT", "https://homecoming-74f73-default-rtdb.europe-west1.firebasedatabase.app")
 
@@ -28,8 +48,10 @@ ELEVEN_VOICE_ID  = os.getenv("ELEVEN_VOICE_ID", "rjyk3ukVFAi8OdkRXxK2")
 ELEVEN_MODEL_ID  = os.getenv("ELEVEN_MODEL_ID", "eleven_monolingual_v1")
 ELEVEN_VOICE_SETTINGS = {"stability": 0.6, "similarity_boost": 0.75}
 CHAT_TTS_DEFAULT = os.getenv("CHAT_TTS", "1") == "1"
+AUDIO_PATH       = os.getenv("AUDIO_PATH", "/tmp/audio.mp3")
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+# No SDK-level retries: _openai_chat_with_retry() retries within the request budget
+openai_client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0) if OPENAI_API_KEY else None
 
 # ---------- Traits ----------
 PERSONALITY_TRAITS = ["extraversion", "intuition", "feeling", "perceiving"]
@@ -71,6 +93,30 @@ def require_api_key(f):
 # ---------- Small helpers ----------
 def clamp(v, lo, hi): return max(lo, min(hi, v))
 
+# ---------- Latency budget ----------
+# A deadline is a time.monotonic() timestamp (None = no budget). Every stage keeps its own cap
+# and is shortened to whatever is left; optional stages are shed below their minimum.
+CHAT_DEADLINE_MS   = int(os.getenv("CHAT_DEADLINE_MS", "30000"))  # 0 = no request budget
+STAGE_MIN_TIMEOUT  = 0.5
+SHED_WEB_BELOW_MS    = int(os.getenv("SHED_WEB_BELOW_MS", "15000"))
+SHED_TAGGER_BELOW_MS = int(os.getenv("SHED_TAGGER_BELOW_MS", "4000"))
+SHED_TTS_BELOW_MS    = int(os.getenv("SHED_TTS_BELOW_MS", "5000"))
+# Required writes (log entries, profile, state_version) are never shortened or shed: they keep
+# their own caps, and the stages before them work to a deadline this much earlier (at most half the budget)
+PERSIST_RESERVE_MS   = int(os.getenv("PERSIST_RESERVE_MS", "2500"))
+
+def make_deadline(ms):
+    return time.monotonic() + ms / 1000.0 if ms and ms > 0 else None
+
+def remaining_ms(deadline):
+    return float("inf") if deadline is None else max(0.0, (deadline - time.monotonic()) * 1000.0)
+
+def stage_timeout(deadline, cap):
+    """Per-call timeout in seconds: the stage's own cap, shortened to the remaining request budget."""
+    if deadline is None:
+        return cap
+    return max(STAGE_MIN_TIMEOUT, min(cap, deadline - time.monotonic()))
+
 def get_center_values():
     return {
         "personality": {"extraversion": 300, "intuition": 700, "feeling": 800, "perceiving": 600},
@@ -119,23 +165,25 @@ def calculate_mbti(p):
            ("P" if p["perceiving"] >=500 else "J")
 
 # ---------- OpenAI ----------
-def _openai_chat_with_retry(messages, model, n_tries=3, timeout=30):
+def _openai_chat_with_retry(messages, model, n_tries=3, timeout=30, deadline=None):
     if not openai_client:
         raise RuntimeError("OPENAI_API_KEY missing")
     last_err = None
     for i in range(n_tries):
+        if i and remaining_ms(deadline) < STAGE_MIN_TIMEOUT * 1000:
+            break  # no budget left for another try
         try:
             return openai_client.chat.completions.create(
                 model=model,
                 messages=messages,
-                timeout=timeout
+                timeout=stage_timeout(deadline, timeout)
             )
         except Exception as e:
             last_err = e
             print(f"[openai] try {i+1}/{n_tries} failed:", e)
     raise last_err
 
-def get_tags_persona(text):
+def get_tags_persona(text, deadline=None):
     prompt = f"""
 Return ONLY JSON with:
 - "tags": string[]
@@ -153,6 +201,7 @@ Text:
                 {"role":"user","content":prompt}
             ],
             timeout=20,
+            deadline=deadline,
         )
         content = (resp.choices[0].message.content or "").strip()
         if content.startswith("```"):
@@ -164,46 +213,279 @@ Text:
         print("Tagger error:", e)
         return {"tags":[], "persona_delta":{}, "mood_delta":{}, "context_intensity":"normal"}
 
+# ---------- Shared cache (one SQLite file for every worker on this host) ----------
+SHARED_CACHE_PATH     = os.getenv("SHARED_CACHE_PATH", "/tmp/kai_cache.sqlite3")
+SHARED_CACHE_MAX_ROWS = int(os.getenv("SHARED_CACHE_MAX_ROWS", "5000"))
+PROFILE_CACHE_TTL     = float(os.getenv("PROFILE_CACHE_TTL", "30"))
+CSE_CACHE_TTL         = float(os.getenv("CSE_CACHE_TTL", "300"))
+GEO_CACHE_TTL         = float(os.getenv("GEO_CACHE_TTL", "86400"))
+
+_cache_local = threading.local()
+_cache_writes = [0]
+
+def _cache_db():
+    # One connection per thread, reopened after fork (sqlite handles must not cross processes)
+    db = getattr(_cache_local, "db", None)
+    if db is None or _cache_local.pid != os.getpid():
+        db = sqlite3.connect(SHARED_CACHE_PATH, timeout=2, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache(expires)")
+        db.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                   "actor TEXT NOT NULL, type TEXT NOT NULL, data TEXT NOT NULL)")
+        _cache_local.db, _cache_local.pid = db, os.getpid()
+    return db
+
+def cache_get(key):
+    try:
+        row = _cache_db().execute("SELECT value, expires FROM cache WHERE key=?", (key,)).fetchone()
+        if row and row[1] > time.time():
+            return json.loads(row[0])
+    except Exception as e:
+        print("cache_get warn:", e)
+    return None
+
+def cache_set(key, value, ttl):
+    try:
+        db = _cache_db()
+        db.execute("INSERT OR REPLACE INTO cache(key, value, expires) VALUES (?,?,?)",
+                   (key, json.dumps(value), time.time() + ttl))
+        _cache_writes[0] += 1
+        if _cache_writes[0] % 100 == 0:
+            # Drop expired rows, then the soonest-expiring ones above the row cap
+            db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires "
+                       "LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))", (SHARED_CACHE_MAX_ROWS,))
+    except Exception as e:
+        print("cache_set warn:", e)
+
+def cache_add(key, value, ttl):
+    """cache_set() unless a live entry exists: read-through fills use this so they never replace a newer write-through."""
+    try:
+        _cache_db().execute("INSERT INTO cache(key, value, expires) VALUES (?,?,?) ON CONFLICT(key) DO UPDATE "
+                            "SET value=excluded.value, expires=excluded.expires WHERE cache.expires <= ?",
+                            (key, json.dumps(value), time.time() + ttl, time.time()))
+    except Exception as e:
+        print("cache_add warn:", e)
+
+def cache_items(prefix):
+    """{key: value} for live keys starting with `prefix`."""
+    try:
+        rows = _cache_db().execute("SELECT key, value FROM cache WHERE key >= ? AND key < ? AND expires > ?",
+                                   (prefix, prefix + "\uffff", time.time())).fetchall()
+        return {k: json.loads(v) for k, v in rows}
+    except Exception as e:
+        print("cache_items warn:", e)
+        return {}
+
+def cache_invalidate(prefix):
+    """Delete every key starting with `prefix`; other workers see it on their next read."""
+    try:
+        _cache_db().execute("DELETE FROM cache WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff"))
+    except Exception as e:
+        print("cache_invalidate warn:", e)
+
+EVENT_RETAIN = int(os.getenv("EVENT_RETAIN", "1000"))  # events kept for Last-Event-ID resume
+_event_writes = [0]
+
+def publish_event(etype, actor, data):
+    """Append to the host-wide event log; each worker's poller fans it out to its /subscribe clients."""
+    try:
+        db = _cache_db()
+        db.execute("INSERT INTO events(actor, type, data) VALUES (?,?,?)", (actor, etype, json.dumps(data)))
+        _event_writes[0] += 1
+        if _event_writes[0] % 100 == 0:
+            db.execute("DELETE FROM events WHERE id <= (SELECT max(id) FROM events) - ?", (EVENT_RETAIN,))
+    except Exception as e:
+        print("publish_event warn:", e)
+
+def _actor_cache_prefix(actor_type, actor_id):
+    return f"actor:{'users' if actor_type=='user' else 'agents'}/{actor_id}:"
+
+def save_audio(content):
+    """Atomic replace so /get-audio on any worker never serves a half-written file."""
+    tmp = f"{AUDIO_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, AUDIO_PATH)
+
+@contextmanager
+def host_lock(path):
+    """Exclusive lock shared by all processes on this host (no-op where fcntl is unavailable)."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 # ---------- Firebase ----------
-def fetch_live_profile(actor_type, actor_id):
+def _over_centers(stored, centers):
+    """What a read returns for a stored trait dict: centers, overridden by the known stored traits."""
+    out = centers.copy()
+    for k,v in (stored or {}).items():
+        if k in out: out[k] = int(v)
+    return out
+
+def fetch_profile_entry(actor_type, actor_id, deadline=None):
+    """
+    {"persona", "mood", "version"} as one cache entry, so the version (the /get_state ETag) always
+    describes that persona/mood. The version is read first, so a write landing mid-read can only make
+    it older than the data. It is None when unreadable; nothing is cached unless all three reads succeed.
+    """
     base = f"{FB_ROOT}/{'users' if actor_type=='user' else 'agents'}/{actor_id}"
+    ck = _actor_cache_prefix(actor_type, actor_id) + "profile"
+    hit = cache_get(ck)
+    if hit:
+        return hit
     centers = get_center_values()
     persona = centers["personality"].copy()
     mood    = centers["mood"].copy()
+    version = None
     try:
-        pr = requests.get(f"{base}/personality_current.json", timeout=8)
+        vr = requests.get(f"{base}/state_version.json", timeout=stage_timeout(deadline, 8))
+        if vr.status_code==200:
+            v = vr.json()
+            version = v if isinstance(v, int) else 0
+        pr = requests.get(f"{base}/personality_current.json", timeout=stage_timeout(deadline, 8))
         if pr.status_code==200 and pr.text and pr.text!="null":
-            for k,v in (pr.json() or {}).items():
-                if k in persona: persona[k] = int(v)
-        mr = requests.get(f"{base}/mood_current.json", timeout=8)
+            persona = _over_centers(pr.json(), persona)
+        mr = requests.get(f"{base}/mood_current.json", timeout=stage_timeout(deadline, 8))
         if mr.status_code==200 and mr.text and mr.text!="null":
-            for k,v in (mr.json() or {}).items():
-                if k in mood: mood[k] = int(v)
+            mood = _over_centers(mr.json(), mood)
+        # Only cache a real answer: a 401/5xx must not serve center values to every worker
+        if version is not None and pr.status_code==200 and mr.status_code==200:
+            cache_add(ck, {"persona": persona, "mood": mood, "version": version}, PROFILE_CACHE_TTL)
     except Exception as e:
         print("fetch_live_profile error:", e)
-    return persona, mood
+    return {"persona": persona, "mood": mood, "version": version}
+
+def fetch_live_profile(actor_type, actor_id, deadline=None):
+    entry = fetch_profile_entry(actor_type, actor_id, deadline)
+    return entry["persona"], entry["mood"]
+
+def _cache_profile_write(actor_type, actor_id, persona, mood, version):
+    """Write-through after a successful profile write, so a read that raced it can't refill the old profile."""
+    if version is None:
+        return  # version unknown: leave it to the next read
+    centers = get_center_values()
+    cache_set(_actor_cache_prefix(actor_type, actor_id) + "profile",
+              {"persona": _over_centers(persona, centers["personality"]), "mood": _over_centers(mood, centers["mood"]),
+               "version": version}, PROFILE_CACHE_TTL)
 
 def write_profile(actor_type, actor_id, persona, mood, summary_payload=None, relationship=None):
     base = f"{FB_ROOT}/{'users' if actor_type=='user' else 'agents'}/{actor_id}"
+    prev = cache_get(_actor_cache_prefix(actor_type, actor_id) + "profile")
+    ok = summary_ok = relationship_ok = False
     try:
-        requests.put(f"{base}/personality_current.json", json=persona, timeout=8)
-        requests.put(f"{base}/mood_current.json",        json=mood,    timeout=8)
+        pr = requests.put(f"{base}/personality_current.json", json=persona, timeout=8)
+        mr = requests.put(f"{base}/mood_current.json",        json=mood,    timeout=8)
+        ok = pr.status_code == 200 and mr.status_code == 200
         if summary_payload:
-            requests.put(f"{base}/personality_summary.json", json=summary_payload, timeout=8)
+            summary_ok = requests.put(f"{base}/personality_summary.json", json=summary_payload, timeout=8).status_code == 200
         if relationship is not None:
-            requests.put(f"{base}/relationship_current.json", json=relationship, timeout=8)
+            relationship_ok = requests.put(f"{base}/relationship_current.json", json=relationship, timeout=8).status_code == 200
     except Exception as e:
         print("write_profile error:", e)
+    version = bump_state_version(actor_type, actor_id)
+    cache_invalidate(_actor_cache_prefix(actor_type, actor_id))
+    if not ok:
+        return  # nothing committed, nothing to push
+    _cache_profile_write(actor_type, actor_id, persona, mood, version)
+
+    # Push a diff against the last cached profile (full values when there is none)
+    diff = {"personality_current": persona, "mood_current": mood, "full": prev is None}
+    if prev:
+        diff["personality_current"] = {k: v for k, v in (persona or {}).items() if prev["persona"].get(k) != v}
+        diff["mood_current"]        = {k: v for k, v in (mood or {}).items() if prev["mood"].get(k) != v}
+    if summary_ok:
+        diff["personality_summary"] = summary_payload
+    if relationship_ok:
+        diff["relationship"] = relationship
+    publish_event("state", f"{'users' if actor_type=='user' else 'agents'}/{actor_id}", {**diff, "state_version": version})
+
+# ---------- State versions (ETag for /get_state) ----------
+# Every profile write bumps <actor>/state_version with a server-side increment; the value lives in
+# the actor's profile cache entry so a matching If-None-Match costs no upstream call.
+STATE_VERSION_INCREMENT = {".sv": {"increment": 1}}
+
+def bump_state_version(actor_type, actor_id):
+    base = f"{FB_ROOT}/{'users' if actor_type=='user' else 'agents'}/{actor_id}"
+    try:
+        r = requests.put(f"{base}/state_version.json", json=STATE_VERSION_INCREMENT, timeout=8)
+        v = r.json() if r.status_code == 200 else None
+        if isinstance(v, int):
+            return v
+    except Exception as e:
+        print("state_version bump warn:", e)
+    return None
+
+def get_state_version(actor_type, actor_id):
+    return fetch_profile_entry(actor_type, actor_id)["version"]
 
 def log_unified(payload, key=None):
     ts = datetime.now().strftime("%Y%m%dT%H%M%S")
     k  = key or f"{ts}-app-Kai"
     try:
-        requests.put(f"{FB_ROOT}/unified_log/{k}.json", json=payload, timeout=8)
+        r = requests.put(f"{FB_ROOT}/unified_log/{k}.json", json=payload, timeout=8)
+        if r.status_code == 200:  # push only what actually committed
+            publish_event("log", "unified_log", {"key": k, "entry": payload})
+        else:
+            print("unified_log write error:", r.status_code, r.text[:200])
     except Exception as e:
         print("unified_log write error:", e)
     return k
 
+def profile_paths(actor_type, actor_id, persona, mood, summary_payload=None, relationship=None):
+    """Same fields write_profile() PUTs, as {path: value} for a multi-path write_batch()."""
+    base = f"{'users' if actor_type=='user' else 'agents'}/{actor_id}"
+    out = {f"{base}/personality_current": persona, f"{base}/mood_current": mood}
+    if summary_payload:
+        out[f"{base}/personality_summary"] = summary_payload
+    if relationship is not None:
+        out[f"{base}/relationship_current"] = relationship
+    return out
+
+def write_batch(updates):
+    """One multi-path PATCH at the RTDB root: {"unified_log/<key>": {...}, "agents/Kai/...": {...}}."""
+    if not updates:
+        return True
+    actors = {"/".join(p.split("/")[:2]) for p in updates if p.startswith(("users/", "agents/"))}
+    updates = {**updates, **{f"{a}/state_version": STATE_VERSION_INCREMENT for a in actors}}
+    versions = {}
+    try:
+        r = requests.patch(f"{FB_ROOT}/.json", json=updates, timeout=8)
+        ok = r.status_code == 200
+        if ok:
+            # The response echoes the written paths with server values resolved
+            body = r.json() or {}
+            versions = {a: body.get(f"{a}/state_version") for a in actors}
+            versions = {a: v for a, v in versions.items() if isinstance(v, int)}
+    except Exception as e:
+        print("write_batch error:", e)
+        ok = False
+    for actor in actors:
+        cache_invalidate(f"actor:{actor}:")
+    if ok:
+        for actor in actors:
+            kind, actor_id = actor.split("/")
+            if f"{actor}/personality_current" in updates and f"{actor}/mood_current" in updates:
+                _cache_profile_write("user" if kind == "users" else "agent", actor_id,
+                                     updates[f"{actor}/personality_current"], updates[f"{actor}/mood_current"],
+                                     versions.get(actor))
+        for p in sorted(updates):
+            if p.startswith("unified_log/"):
+                publish_event("log", "unified_log", {"key": p[len("unified_log/"):], "entry": updates[p]})
+        for actor in actors:
+            fields = {p.split("/", 2)[2]: v for p, v in updates.items()
+                      if p.startswith(actor + "/") and not p.endswith("/state_version")}
+            publish_event("state", actor, {**fields, "full": True, "state_version": versions.get(actor)})
+    return ok
+
 # ---------- Flask ----------
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": os.getenv("ALLOWED_ORIGINS", "*").split(",")}})
@@ -222,6 +504,168 @@ def diag_auth():
         "has_x_api_key": bool(request.headers.get(API_KEY_HEADER)),
     })
 
+# ---------- Profiling (opt-in sampling, collapsed-stack output) ----------
+ADMIN_KEY_HEADER    = "x-admin-key"
+ADMIN_KEY_VALUE     = os.getenv("ADMIN_KEY_VALUE")
+PROFILE_HEADER      = "x-profile"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_SLOWEST     = int(os.getenv("PROFILE_SLOWEST", "0"))  # keep the N slowest requests; 0 = off
+PROFILE_TTL         = float(os.getenv("PROFILE_TTL", "3600"))
+
+_prof_lock   = threading.Lock()
+_prof_active = {}      # request thread ident -> Counter of collapsed stacks
+_prof_state  = {"sampler": None, "slowest": [], "seq": 0}
+
+def _is_admin():
+    got = request.headers.get(ADMIN_KEY_HEADER) or ""
+    return bool(ADMIN_KEY_VALUE) and hmac.compare_digest(got, ADMIN_KEY_VALUE)
+
+def require_admin(f):
+    @wraps(f)
+    def w(*a, **k):
+        if request.method == "OPTIONS":
+            return make_response("", 200)
+        if not ADMIN_KEY_VALUE:
+            return jsonify({"status":"error","error":"Profiling disabled (ADMIN_KEY_VALUE not set)."}), 403
+        if not _is_admin():
+            return jsonify({"status":"error","error":"Invalid or missing admin key"}), 403
+        return f(*a, **k)
+    return w
+
+def _collapse(frame):
+    parts = []
+    while frame is not None:
+        parts.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+def _sampler_loop():
+    interval = PROFILE_INTERVAL_MS / 1000.0
+    while True:
+        time.sleep(interval)
+        with _prof_lock:
+            if not _prof_active:
+                _prof_state["sampler"] = None  # idle: exit, next profiled request restarts it
+                return
+            frames = sys._current_frames()
+            for tid, stacks in _prof_active.items():
+                f = frames.get(tid)
+                if f is not None:
+                    stacks[_collapse(f)] += 1
+
+def collapsed_text(stacks):
+    """Brendan Gregg's folded format: 'frame;frame;frame count' per line (flamegraph.pl, speedscope)."""
+    return "\n".join(f"{k} {v}" for k, v in sorted(stacks.items())) + "\n"
+
+@app.before_request
+def _profile_begin():
+    explicit = request.headers.get(PROFILE_HEADER) == "1"
+    if not (PROFILE_SLOWEST or explicit):
+        return
+    if explicit and not _is_admin():
+        explicit = False
+        if not PROFILE_SLOWEST:
+            return
+    g.profile = {"explicit": explicit, "t0": time.perf_counter(), "stacks": Counter()}
+    with _prof_lock:
+        _prof_active[threading.get_ident()] = g.profile["stacks"]
+        if _prof_state["sampler"] is None:
+            t = threading.Thread(target=_sampler_loop, name="profile-sampler", daemon=True)
+            _prof_state["sampler"] = t
+            t.start()
+
+@app.after_request
+def _profile_end(resp):
+    prof = g.pop("profile", None)
+    if prof is None:
+        return resp
+    with _prof_lock:
+        _prof_active.pop(threading.get_ident(), None)
+        _prof_state["seq"] += 1
+        pid = f"{os.getpid()}-{_prof_state['seq']}"
+    rec = {
+        "id": pid, "method": request.method, "path": request.path, "status": resp.status_code,
+        "duration_ms": round((time.perf_counter() - prof["t0"]) * 1000, 1),
+        "samples": sum(prof["stacks"].values()), "at": datetime.now().strftime("%Y%m%dT%H%M%S"),
+    }
+    if prof["explicit"]:
+        cache_set(f"profile:capture:{pid}", {**rec, "collapsed": collapsed_text(prof["stacks"])}, PROFILE_TTL)
+        resp.headers["X-Profile-Id"] = pid
+    if PROFILE_SLOWEST:
+        with _prof_lock:
+            heap = _prof_state["slowest"]
+            item = (rec["duration_ms"], pid, {**rec, "stacks": dict(prof["stacks"])})
+            if len(heap) < PROFILE_SLOWEST:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+            else:
+                return resp
+            snapshot = [r for _, _, r in heap]
+        # Per-worker list in the shared cache so any worker can serve /profile/slowest
+        cache_set(f"profile:slowest:{os.getpid()}", snapshot, PROFILE_TTL)
+    return resp
+
+@app.teardown_request
+def _profile_teardown(_exc):
+    with _prof_lock:
+        _prof_active.pop(threading.get_ident(), None)
+
+@app.get("/profile/slowest")
+@require_admin
+def profile_slowest():
+    """Slowest requests across workers; ?format=collapsed merges their stacks into one download."""
+    recs = [r for rows in cache_items("profile:slowest:").values() for r in (rows or [])]
+    recs.sort(key=lambda r: -r["duration_ms"])
+    if request.args.get("format") == "collapsed":
+        merged = Counter()
+        for r in recs:
+            merged.update(r.get("stacks") or {})
+        resp = make_response(collapsed_text(merged))
+        resp.headers["Content-Type"] = "text/plain; charset=utf-8"
+        resp.headers["Content-Disposition"] = "attachment; filename=slowest.collapsed"
+        return resp
+    return jsonify({"status":"success", "requests": [{k: v for k, v in r.items() if k != "stacks"} for r in recs]})
+
+@app.get("/profile/<pid>")
+@require_admin
+def profile_capture(pid):
+    """Collapsed stacks for one capture: X-Profile-Id of an explicit capture or an id from /profile/slowest."""
+    rec = cache_get(f"profile:capture:{pid}")
+    if rec is None:
+        for rows in cache_items("profile:slowest:").values():
+            for r in rows or []:
+                if r["id"] == pid:
+                    rec = {**r, "collapsed": collapsed_text(r.get("stacks") or {})}
+    if rec is None:
+        return jsonify({"status":"error","error":"Unknown or expired profile id"}), 404
+    resp = make_response(rec["collapsed"])
+    resp.headers["Content-Type"] = "text/plain; charset=utf-8"
+    resp.headers["Content-Disposition"] = f"attachment; filename=profile-{pid}.collapsed"
+    return resp
+
+# ---------- Response compression ----------
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+
+@app.after_request
+def _compress_json(resp):
+    if (resp.status_code < 200 or resp.status_code in (204, 304) or resp.direct_passthrough
+            or resp.mimetype != "application/json" or "Content-Encoding" in resp.headers):
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return resp
+    if brotli is not None and request.accept_encodings["br"]:
+        body, enc = brotli.compress(body, quality=5), "br"
+    elif request.accept_encodings["gzip"]:
+        body, enc = gzip.compress(body, compresslevel=6), "gzip"
+    else:
+        return resp
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = enc
+    resp.headers.add("Vary", "Accept-Encoding")
+    return resp
+
 # ---------- State ----------
 @app.route("/set_state", methods=["POST","OPTIONS"])
 @require_api_key
@@ -245,16 +689,44 @@ def get_state():
     try:
         actor_type = request.args.get("actor_type", "agent")
         actor_id   = "Darc" if actor_type=="user" else "Kai"
-        persona, mood = fetch_live_profile(actor_type, actor_id)
+
+        # The ETag is the version stored with this persona/mood; recent_deltas come from Kai's
+        # turns, so the user's view also depends on Kai's version
+        entry = fetch_profile_entry(actor_type, actor_id)
+        versions = [entry["version"]]
+        if actor_type == "user":
+            versions.append(get_state_version("agent", "Kai"))
+        etag = None if None in versions else f"{actor_type}-" + "-".join(f"v{v}" for v in versions)
+        if etag and request.if_none_match.contains_weak(etag):
+            resp = make_response("", 304)
+            resp.set_etag(etag, weak=True)
+            resp.headers["Cache-Control"] = "no-cache"
+            return resp
+
+        persona, mood = entry["persona"], entry["mood"]
         base = f"{FB_ROOT}/{'users' if actor_type=='user' else 'agents'}/{actor_id}"
-        try:
-            summary = requests.get(f"{base}/personality_summary.json", timeout=8).json()
-        except:
-            summary = None
-        try:
-            relationship = requests.get(f"{base}/relationship_current.json", timeout=8).json()
-        except:
-            relationship = None
+        extra = cache_get(_actor_cache_prefix(actor_type, actor_id) + "extra")
+        if extra:
+            summary, relationship = extra["summary"], extra["relationship"]
+        else:
+            summary = relationship = None
+            reads_ok = True
+            try:
+                r = requests.get(f"{base}/personality_summary.json", timeout=8)
+                reads_ok = r.status_code == 200
+                summary = r.json() if reads_ok else None
+            except:
+                reads_ok = False
+            try:
+                r = requests.get(f"{base}/relationship_current.json", timeout=8)
+                reads_ok = reads_ok and r.status_code == 200
+                relationship = r.json() if r.status_code == 200 else None
+            except:
+                reads_ok = False
+            # Same rule as profiles: an error body or a failed read must not be cached for every worker
+            if reads_ok:
+                cache_add(_actor_cache_prefix(actor_type, actor_id) + "extra",
+                          {"summary": summary, "relationship": relationship}, PROFILE_CACHE_TTL)
         if not relationship: relationship = {"intimacy":50, "physicality":50}
 
         recent = []
@@ -272,7 +744,7 @@ def get_state():
         except Exception as e:
             print("recent_deltas error:", e)
 
-        return jsonify({
+        resp = jsonify({
             "status":"success",
             "personality_current": persona,
             "mood_current": mood,
@@ -280,11 +752,117 @@ def get_state():
             "relationship": relationship,
             "affinity_current": relationship,
             "recent_deltas": recent,
+            "state_version": versions[0],
         })
+        if etag:
+            resp.set_etag(etag, weak=True)
+            resp.headers["Cache-Control"] = "no-cache"
+        return resp
     except Exception as e:
         traceback.print_exc()
         return jsonify({"status":"error","error":str(e)}), 500
 
+# ---------- Push channel (Server-Sent Events) ----------
+SSE_BUFFER          = int(os.getenv("SSE_BUFFER", "100"))           # queued events per client before it is dropped
+# Under gunicorn gthread every open stream holds one worker thread for its lifetime, so streams
+# get at most half of GUNICORN_THREADS (default a quarter) and the rest stay free for /chat etc.
+# More subscribers: raise GUNICORN_THREADS or WEB_CONCURRENCY.
+_WORKER_THREADS     = int(os.getenv("GUNICORN_THREADS", "16"))
+SSE_MAX_SUBSCRIBERS = min(int(os.getenv("SSE_MAX_SUBSCRIBERS", str(max(1, _WORKER_THREADS // 4)))),
+                          max(1, _WORKER_THREADS // 2))  # per worker
+SSE_HEARTBEAT_S     = 15
+EVENT_POLL_S        = float(os.getenv("EVENT_POLL_S", "0.2"))
+
+_subs_lock = threading.Lock()
+_subs      = []  # {"q", "actors", "types", "slow"}
+_events_state = {"poller": None, "last_id": 0}
+
+def _deliver(sub, row):
+    eid, actor, etype, data = row
+    if etype not in sub["types"] or (actor != "unified_log" and actor not in sub["actors"]):
+        return
+    if sub["slow"]:
+        return
+    if sub["q"].qsize() >= SSE_BUFFER:
+        sub["slow"] = True
+        sub["q"].put_nowait(None)  # reserved slot: wakes the stream so it can close
+        return
+    sub["q"].put_nowait((eid, etype, data))
+
+def _event_poller():
+    while True:
+        time.sleep(EVENT_POLL_S)
+        with _subs_lock:
+            if not _subs:
+                _events_state["poller"] = None  # idle: next subscriber restarts it
+                return
+            try:
+                rows = _cache_db().execute("SELECT id, actor, type, data FROM events WHERE id > ? ORDER BY id",
+                                           (_events_state["last_id"],)).fetchall()
+            except Exception as e:
+                print("event poller warn:", e)
+                continue
+            for row in rows:
+                for sub in _subs:
+                    _deliver(sub, row)
+                _events_state["last_id"] = row[0]
+
+@app.route("/subscribe", methods=["GET","OPTIONS"])
+@require_api_key
+def subscribe():
+    """
+    SSE stream of actor-state diffs ("state") and new unified_log entries ("log").
+    Query: actor_type=agent|user|all (default agent), types=state,log. EventSource can't send
+    headers, so pass api_key=… in the query. Reconnects resume from Last-Event-ID while the
+    event is still retained; a client that falls SSE_BUFFER events behind is disconnected.
+    """
+    actor_type = request.args.get("actor_type", "agent")
+    actors = {"agent": {"agents/Kai"}, "user": {"users/Darc"}}.get(actor_type, {"agents/Kai", "users/Darc"})
+    types  = set((request.args.get("types") or "state,log").split(","))
+    since  = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    sub = {"q": queue.Queue(maxsize=SSE_BUFFER + 1), "actors": actors, "types": types, "slow": False}
+
+    with _subs_lock:
+        if len(_subs) >= SSE_MAX_SUBSCRIBERS:
+            resp = jsonify({"status":"error","error":"Too many subscribers"})
+            resp.headers["Retry-After"] = "10"
+            return resp, 503
+        if _events_state["poller"] is None:
+            row = _cache_db().execute("SELECT max(id) FROM events").fetchone()
+            _events_state["last_id"] = row[0] or 0
+            t = threading.Thread(target=_event_poller, name="event-poller", daemon=True)
+            _events_state["poller"] = t
+            t.start()
+        if since and since.isdigit():
+            for row in _cache_db().execute("SELECT id, actor, type, data FROM events WHERE id > ? AND id <= ? ORDER BY id",
+                                           (int(since), _events_state["last_id"])).fetchall():
+                _deliver(sub, row)
+        _subs.append(sub)
+
+    def stream():
+        try:
+            yield f"retry: 3000\n: subscribed {','.join(sorted(actors))}\n\n"
+            while True:
+                try:
+                    evt = sub["q"].get(timeout=SSE_HEARTBEAT_S)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if evt is None:
+                    yield 'event: error\ndata: {"error":"slow consumer, reconnect with Last-Event-ID"}\n\n'
+                    return
+                eid, etype, data = evt
+                yield f"id: {eid}\nevent: {etype}\ndata: {data}\n\n"
+        finally:
+            with _subs_lock:
+                if sub in _subs:
+                    _subs.remove(sub)
+
+    resp = Response(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # don't let nginx buffer the stream
+    return resp
+
 # ---------- TTS ----------
 @app.route("/tts", methods=["POST","OPTIONS"])
 @require_api_key
@@ -307,8 +885,7 @@ def tts_from_text():
         if resp.status_code != 200:
             return jsonify({"status":"success","tts_base64":"","warning":"TTS unavailable"}), 200
 
-        with open("/tmp/audio.mp3","wb") as f:
-            f.write(resp.content)
+        save_audio(resp.content)
         b64 = base64.b64encode(resp.content).decode("utf-8")
         return jsonify({"status":"success","tts_base64": b64})
     except Exception as e:
@@ -317,14 +894,14 @@ def tts_from_text():
 
 @app.route("/get-audio", methods=["GET"])
 def get_audio():
-    p = "/tmp/audio.mp3"
+    p = AUDIO_PATH
     if not os.path.exists(p):
         return jsonify({"status":"error","error":"No audio available"}), 404
     return send_file(p, mimetype="audio/mpeg", as_attachment=True, download_name="kai.mp3")
 
 # ---------- Google Custom Search (with diagnostics) ----------
 def google_cse(query: str, num: int = 5, *, date_restrict: str = "d1",
-               lang: str = "en", gl: str = "us", news_bias: bool = True):
+               lang: str = "en", gl: str = "us", news_bias: bool = True, deadline=None):
     """
     Returns (results, diag) where:
       results: list[{title, link, displayLink, snippet, publishedAt}]
@@ -367,10 +944,15 @@ def google_cse(query: str, num: int = 5, *, date_restrict: str = "d1",
     if dr:
         params["dateRestrict"] = dr
 
+    ck = "cse:" + hashlib.sha1(json.dumps([q, params["num"], lang, gl, dr]).encode("utf-8")).hexdigest()
+    hit = cache_get(ck)
+    if hit:
+        return hit["results"], {**hit["diag"], "cached": True}
+
     try:
         url = "https://www.googleapis.com/customsearch/v1?" + urlencode(params)
         diag["url"] = url
-        r = requests.get(url, timeout=12)
+        r = requests.get(url, timeout=stage_timeout(deadline, 12))
         diag["status"] = r.status_code
 
         if r.status_code != 200:
@@ -411,6 +993,8 @@ def google_cse(query: str, num: int = 5, *, date_restrict: str = "d1",
         diag["ok"] = True
         if not out:
             diag["error"] = "No items returned (engine restrictions or empty results)."
+        else:
+            cache_set(ck, {"results": out, "diag": {**diag, "url": None}}, CSE_CACHE_TTL)
         return out, diag
     except Exception as e:
         diag["error"] = f"Exception: {e}"
@@ -464,6 +1048,8 @@ _NEWSY = re.compile(
 _TIMEY    = re.compile(r"(?i)\b(time|current time|what time is it|time in)\b")
 _WEATHERY = re.compile(r"(?i)\b(weather|forecast|temperature|rain|wind|humidity|uv index)\b")
 
+_HEADLINEY = re.compile(r"(?i)\b(news|headlines|breaking|top stories|latest)\b")
+
 _YEAR   = re.compile(r"\b(19\d{2}|20[0-5]\d)\b")
 _URLISH = re.compile(r"https?://|www\.", re.IGNORECASE)
 
@@ -489,14 +1075,18 @@ def _extract_place(q, keywords=("time in", "weather in", "forecast in")):
     m = re.search(r"(?i)\bin\s+([a-zA-Z\s,]+)$", q.strip())
     return (m.group(1).strip(" ?.,") if m else "").lower()
 
-def _current_time_payload(q):
-    place = _extract_place(q, ("time in",))
+def _current_time_payload(q, deadline=None, place=None):
+    if place is None:
+        place = _extract_place(q, ("time in",))
     tz = None
     if place in _CITY_TO_TZ:
         tz = _CITY_TO_TZ[place]
     elif place:
         try:
-            all_tz = requests.get("http://worldtimeapi.org/api/timezone", timeout=8).json()
+            all_tz = cache_get("geo:tz_list")
+            if not all_tz:
+                all_tz = requests.get("http://worldtimeapi.org/api/timezone", timeout=stage_timeout(deadline, 8)).json()
+                cache_set("geo:tz_list", all_tz, GEO_CACHE_TTL)
             cand = [z for z in all_tz if place.replace(" ", "_") in z.lower()]
             tz = cand[0] if cand else None
         except Exception as e:
@@ -504,7 +1094,7 @@ def _current_time_payload(q):
     if not tz:
         tz = "Asia/Bahrain"  # default
     try:
-        r = requests.get(f"http://worldtimeapi.org/api/timezone/{tz}", timeout=8)
+        r = requests.get(f"http://worldtimeapi.org/api/timezone/{tz}", timeout=stage_timeout(deadline, 8))
         j = r.json()
         iso = j.get("datetime")
         offset = j.get("utc_offset")
@@ -520,33 +1110,38 @@ def _current_time_payload(q):
         return "Sorry—I couldn’t get the time right now, even locally."
 
 # --- Native Weather intent (Open-Meteo) ---
-def _geocode_city(city_name):
+def _geocode_city(city_name, deadline=None):
+    hit = cache_get(f"geo:city:{city_name.lower()}")
+    if hit:
+        return tuple(hit)
     try:
         r = requests.get(
             "https://geocoding-api.open-meteo.com/v1/search",
             params={"name": city_name, "count": 1, "language": "en", "format": "json"},
-            timeout=8,
+            timeout=stage_timeout(deadline, 8),
         )
         j = r.json() or {}
         if (j.get("results") or []):
             it = j["results"][0]
-            return it["latitude"], it["longitude"], it.get("name"), it.get("country")
+            out = (it["latitude"], it["longitude"], it.get("name"), it.get("country"))
+            cache_set(f"geo:city:{city_name.lower()}", out, GEO_CACHE_TTL)
+            return out
     except Exception as e:
         print("geocode warn:", e)
     return None, None, None, None
 
-def _current_weather_payload(q):
-    city = _extract_place(q, ("weather in", "forecast in"))
+def _current_weather_payload(q, deadline=None, place=None):
+    city = _extract_place(q, ("weather in", "forecast in")) if place is None else place
     if not city:
         city = "Manama"
-    lat, lon, name, country = _geocode_city(city)
+    lat, lon, name, country = _geocode_city(city, deadline)
     if lat is None or lon is None:
         return "Sorry—I couldn’t resolve that location."
     try:
         r = requests.get(
             "https://api.open-meteo.com/v1/forecast",
             params={"latitude": lat, "longitude": lon, "current": "temperature_2m,wind_speed_10m,relative_humidity_2m"},
-            timeout=8,
+            timeout=stage_timeout(deadline, 8),
         )
         j = r.json() or {}
         cur = j.get("current") or {}
@@ -565,28 +1160,255 @@ def _current_weather_payload(q):
         print("weather warn:", e)
         return "Sorry—I couldn’t fetch the weather right now."
 
+# --- Intent router: every intent in one combined pattern, classified in a single pass ---
+# Keyword intents are merged into one prefix trie, so a position costs the length of the
+# longest shared prefix rather than the number of keywords; a few raw regexes sit beside it.
+# The trie is one named group (the matched phrase maps back to its intents) and each raw regex
+# gets its own, so m.lastgroup says what fired. Keep the group count small: sre saves every
+# group mark when it backtracks. Matching runs on the lowercased text without re.IGNORECASE,
+# which keeps sre's literal fast paths.
+INTENTS = []
+_router = {"compiled": None}
+_CAPTURING = re.compile(r"(?<!\\)\((?!\?)")
+_LITERAL   = re.compile(r"[a-z0-9 ]+")
+_PLACE_REST = re.compile(r"\s+([a-z\s,]+)")  # what _extract_place's fallback accepts after "in"
+
+def _from_regex(rx, extra=()):
+    """
+    register_intent() arguments for a `(?i)\b(a|b c|...)\b` pattern (keeps _TIMEY & co. the single
+    source): literal alternatives go to the keyword trie, the rest (e.g. right\s*now) stay a regex.
+    """
+    body = rx.pattern.replace("(?i)", "")
+    alts = body[body.index("(") + 1:body.rindex(")")].split("|")
+    rest = [a for a in alts if not _LITERAL.fullmatch(a)]
+    return {"keywords": [a for a in alts if _LITERAL.fullmatch(a)] + list(extra),
+            "regex": r"\b(?:" + "|".join(rest) + r")\b" if rest else None}
+
+def register_intent(name, action, priority, keywords=(), regex=None, min_words=0):
+    """
+    Add an intent to the router. action: "time" | "weather" | "headlines" | "web" (or any label
+    the caller handles); the highest-priority intent found decides the route. Keyword phrases
+    ending in " in" make the rest of the message that intent's place entity (first such keyword
+    in registration order wins, like _extract_place). `regex` is matched against the lowercased message.
+    """
+    INTENTS.append({"name": name, "action": action, "priority": priority,
+                    "keywords": [" ".join(k.lower().split()) for k in keywords],
+                    "regex": regex, "min_words": min_words})
+    _router["compiled"] = None
+
+def _trie_pattern(phrases):
+    """Phrases → regex with shared prefixes factored out; longest alternative first."""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[""] = True
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if "" in node:
+            alts.append("")
+        return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+    return build(trie) if trie else None
+
+def compile_router(intents):
+    phrases, places, place_kws, marks, raws = {}, {}, {}, {}, []
+    for it in intents:
+        for kw in it["keywords"]:
+            phrases.setdefault(kw, []).append(it["name"])
+        if it["regex"]:
+            mark = f"r{len(raws)}"
+            body = _CAPTURING.sub("(?:", it["regex"].replace("(?i)", ""))  # keep the marker as m.lastgroup
+            raws.append(f"(?P<{mark}>{body})")
+            marks[mark] = [it["name"]]
+    # A place keyword ("time in") can end a longer phrase ("current time in"); add those phrases
+    # so the longest-match trie never swallows it
+    for it in intents:
+        for kw in [k for k in it["keywords"] if k.endswith(" in")]:
+            place_kws.setdefault(it["name"], []).append(kw)
+            places.setdefault(kw, []).append((it["name"], kw))
+            head = kw[:-len(" in")]
+            for p in [p for p in phrases if p.endswith(" " + head) and not p.endswith(" in")]:
+                names = phrases.setdefault(p + " in", [])
+                names += [n for n in phrases[p] if n not in names]
+                places.setdefault(p + " in", []).append((it["name"], kw))
+    alts = []
+    trie = _trie_pattern(phrases)
+    if trie:
+        alts.append(rf"(?P<kw>\b{trie}\b)")
+    alts += raws
+    # Place entity fallback ("... in <letters to the end>"); the lookahead doesn't consume the tail
+    alts.append(r"(?P<place_tail>\bin\s+(?=(?P<place>[a-z\s,]+)$))")
+    return {"rx": re.compile("|".join(alts)), "marks": marks, "phrases": phrases, "places": places,
+            "place_kws": place_kws, "intents": {it["name"]: it for it in intents}}
+
+def classify_intent(text, router=None):
+    """
+    One pass over `text`: {"intent", "action", "search", "place", "matched"}.
+    action is "chat" when nothing fired; search is True for headlines/web routes.
+    """
+    if router is None:
+        router = _router["compiled"] or _router.update(compiled=compile_router(INTENTS)) or _router["compiled"]
+    t = (text or "").strip().lower()
+    matched, kw_place, tail = set(), {}, None
+    for m in router["rx"].finditer(t):
+        g = m.lastgroup
+        if g == "place_tail":
+            if tail is None:
+                tail = m.group("place")
+            continue
+        if g != "kw":
+            matched.update(router["marks"][g])
+            continue
+        phrase = m.group()
+        matched.update(router["phrases"][phrase])
+        for key in router["places"].get(phrase, ()):
+            kw_place.setdefault(key, t[m.end():])
+        if tail is None and phrase.endswith(" in"):
+            # the keyword consumed the "in": its trailing text is the shared place fallback
+            rest = _PLACE_REST.fullmatch(t, m.end())
+            tail = rest.group(1) if rest else None
+    specs = router["intents"]
+    n_words = None
+    for name in [n for n in matched if specs[n]["min_words"]]:
+        n_words = len(t.split()) if n_words is None else n_words
+        if n_words < specs[name]["min_words"]:
+            matched.discard(name)
+    best = max(matched, key=lambda n: specs[n]["priority"]) if matched else None
+    action = specs[best]["action"] if best else "chat"
+    place = next((kw_place[(best, kw)] for kw in router["place_kws"].get(best, ()) if (best, kw) in kw_place), tail)
+    return {"intent": best, "action": action, "search": action in ("headlines", "web"),
+            "place": (place or "").strip(" ?.,"), "matched": sorted(matched)}
+
+register_intent("time",      "time",      100, **_from_regex(_TIMEY))
+register_intent("weather",   "weather",    90, **_from_regex(_WEATHERY, extra=["weather in", "forecast in"]))
+register_intent("headlines", "headlines",  60, **_from_regex(_HEADLINEY))
+register_intent("news",      "web",        50, **_from_regex(_NEWSY))
+register_intent("url",       "web",        50, regex=_URLISH.pattern)
+register_intent("search",    "web",        50, regex=r"search")
+register_intent("year",      "web",        50, regex=_YEAR.pattern)
+register_intent("question",  "web",        40, regex=r"\?", min_words=11)
+
 def should_search(user_text: str) -> bool:
     """
     Decide if we should hit Google CSE for fresh/contextual info.
     We handle time/weather natively; search is for news/results/prices/etc.
     """
-    t = (user_text or "").strip()
-    if not t:
-        return False
-    if _TIMEY.search(t) or _WEATHERY.search(t):
+    return classify_intent(user_text)["search"]
+
+ROUTER_BENCH_CORPUS = [
+    "hey kai", "how are you today?", "what time is it", "what time is it in tokyo", "time in new york",
+    "what's the weather in london", "is it going to rain tomorrow", "forecast in dubai please",
+    "any news about the election?", "top stories", "latest headlines", "who won the nba game last night",
+    "what's the bitcoin price right now", "search for cheap flights to paris", "check www.example.com for me",
+    "what happened in 1999", "tell me a joke", "I had a really rough day at work and I just want to talk",
+    "do you remember what I told you about my sister's birthday", "can you help me plan a trip to rome in spring",
+    "what's the exchange rate for euros in bahrain", "I think I'm getting better at guitar",
+    "why do you think people are afraid of change when it is the only constant in life?",
+    "recommend a movie for tonight", "how's the traffic in manama", "explain inflation like I'm five",
+    "good night kai", "what should I cook for dinner", "thanks, that helped a lot", "play something calm",
+]
+
+def bench_router_cli(argv):
+    """
+    Legacy sequential regexes vs the single-pass router, as synthetic intents are added.
+    Parity is checked on the corpus and on --fuzz random inputs drawn from the intent vocabulary.
+    Known, intended differences: the legacy place lookup matched "time in" / "weather in" /
+    "forecast in" as plain substrings ("time index" -> place "dex", "overtime in ..."); the router
+    only takes whole words. Those are counted separately; anything else is reported as a mismatch.
+    """
+    import argparse, random, string
+    ap = argparse.ArgumentParser(prog="server.py bench-router", description="Intent routing microbenchmark.")
+    ap.add_argument("--corpus", help="text file (one input per line) or unified_log export (JSON)")
+    ap.add_argument("--extra", default="0,25,100,400", help="synthetic intents to add, comma-separated")
+    ap.add_argument("--repeat", type=int, default=200)
+    ap.add_argument("--fuzz", type=int, default=20000, help="random vocabulary inputs for the parity check (0 = off)")
+    args = ap.parse_args(argv)
+
+    corpus = ROUTER_BENCH_CORPUS
+    if args.corpus:
+        with open(args.corpus) as f:
+            raw = f.read()
+        try:
+            logs = json.loads(raw)
+            logs = logs.get("unified_log", logs)
+            corpus = [v["user_input"] for v in logs.values() if isinstance(v, dict) and v.get("user_input")]
+        except ValueError:
+            corpus = [line.strip() for line in raw.splitlines() if line.strip()]
+
+    def legacy_should_search(t):
+        if _TIMEY.search(t) or _WEATHERY.search(t):
+            return False
+        if "search" in t.lower() or _URLISH.search(t):
+            return True
+        if _NEWSY.search(t) or _YEAR.search(t):
+            return True
+        if "?" in t and len(t.split()) > 10:
+            return True
+        return t.lower() in {"news", "headlines", "top news"}
+
+    def legacy_route(t, extra):
+        # The pre-router /chat path: each check rescans the message
+        if _TIMEY.search(t):
+            return "time", _extract_place(t, ("time in",))
+        if _WEATHERY.search(t):
+            return "weather", _extract_place(t, ("weather in", "forecast in"))
+        for rx in extra:
+            rx.search(t)
+        if legacy_should_search(t):
+            return ("headlines" if _HEADLINEY.search(t) else "web"), ""
+        return "chat", ""
+
+    def router_route(t, router):
+        r = classify_intent(t, router)
+        return r["action"], (r["place"] if r["action"] in ("time", "weather") else "")
+
+    def substring_place(t, legacy):
+        # legacy took the place after the first "time in"/"weather in"/"forecast in" even mid-word
+        low = t.lower()
+        for kw in (("time in",) if legacy[0] == "time" else ("weather in", "forecast in")):
+            i = low.find(kw)
+            if i >= 0:
+                return (i > 0 and low[i - 1].isalnum()) or low[i + len(kw):i + len(kw) + 1].isalnum()
         return False
-    if "search" in t.lower() or _URLISH.search(t):
-        return True
-    if _NEWSY.search(t):
-        return True
-    if _YEAR.search(t):
-        return True
-    if "?" in t and len(t.split()) > 10:
-        return True
-    short = t.lower()
-    if short in {"news", "headlines", "top news"}:
-        return True
-    return False
+
+    router0 = compile_router(INTENTS)
+    mismatches = [(t, legacy_route(t, []), router_route(t, router0))
+                  for t in corpus if legacy_route(t, []) != router_route(t, router0)]
+
+    rnd = random.Random(7)
+    vocab = [kw for it in INTENTS for kw in it["keywords"]] + ["in"] * 12 + \
+            "london,new york,paris,abu dhabi,tokyo,the,what's,is,it,and,like,me,about,please,how,kai,my,a,of".split(",") + \
+            "1999,2024,https://x.com,www.y.org,research,rightnow,right now,index,sometime,overtime,info,?,kai?,london?".split(",")
+    fuzz = {"inputs": args.fuzz, "substring_place": 0, "mismatches": []}
+    for _ in range(args.fuzz):
+        toks = [rnd.choice(vocab) for _ in range(rnd.randint(1, 14))]
+        t = "".join((rnd.choices([" ", "  ", "\t", ", "], [90, 4, 2, 4])[0] if i else "") +
+                    (tok.capitalize() if rnd.random() < 0.1 else tok) for i, tok in enumerate(toks))
+        legacy, routed = legacy_route(t, []), router_route(t, router0)
+        if legacy != routed:
+            if legacy[0] == routed[0] and substring_place(t, legacy):
+                fuzz["substring_place"] += 1
+            elif len(fuzz["mismatches"]) < 20:
+                fuzz["mismatches"].append({"text": t, "legacy": legacy, "router": routed})
+    rows = []
+    for n in [int(x) for x in args.extra.split(",") if x.strip()]:
+        extra = [{"name": f"x{i}", "action": "web", "priority": 10, "regex": None, "min_words": 0,
+                  "keywords": ["".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(4, 9))) for _ in range(6)]}
+                 for i in range(n)]
+        extra_rx = [re.compile(r"(?i)\b(" + "|".join(map(re.escape, it["keywords"])) + r")\b") for it in extra]
+        router = compile_router(INTENTS + extra)
+        timings = {}
+        for name, fn in (("legacy", lambda t: legacy_route(t, extra_rx)), ("router", lambda t: router_route(t, router))):
+            t0 = time.perf_counter()
+            for _ in range(args.repeat):
+                for t in corpus:
+                    fn(t)
+            timings[name] = (time.perf_counter() - t0) / (args.repeat * len(corpus)) * 1e6
+        rows.append({"extra_intents": n, "legacy_us": round(timings["legacy"], 2), "router_us": round(timings["router"], 2)})
+    print(json.dumps({"corpus": len(corpus), "repeat": args.repeat, "per_message": rows,
+                      "parity_mismatches": [{"text": t, "legacy": l, "router": r} for t, l, r in mismatches],
+                      "fuzz_parity": fuzz}, indent=2))
 
 def build_web_context(snippets):
     lines = []
@@ -603,11 +1425,397 @@ def build_web_context(snippets):
         "\n\n".join(lines)
     )
 
+# ---------- Long-term memory (local embeddings, memory-mapped index) ----------
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+MEMORY_DIR     = os.getenv("MEMORY_DIR", "/tmp/kai_memory")
+MEMORY_DIM     = int(os.getenv("MEMORY_DIM", "256"))
+MEMORY_TOP_K   = int(os.getenv("MEMORY_TOP_K", "3"))
+MEMORY_MIN_SIM = float(os.getenv("MEMORY_MIN_SIM", "0.2"))
+# Memory recalls older turns, so the short-history window can shrink; history + memories
+# share one prompt budget (newest history first, then memories by rank). 0 = no cap.
+CTX_TURNS_DEFAULT   = int(os.getenv("CTX_TURNS", "8" if MEMORY_ENABLED else "20"))
+PROMPT_CONTEXT_CHARS = int(os.getenv("PROMPT_CONTEXT_CHARS", "3000"))
+
+_MEM_TOKEN = re.compile(r"[a-z0-9']+")
+_MEM_STOP = {
+    "a","an","the","and","or","but","if","is","are","was","were","be","been","am","i","you","me","my","your",
+    "it","its","to","of","in","on","at","for","with","that","this","do","does","did","so","just","what","how",
+    "can","could","would","will","i'm","it's","not","no","yes","ok","okay","kai","have","has","we","he","she","they",
+}
+
+# n = len(meta); the vectors file is pre-grown to `cap` rows
+# Row i of vectors.f32 is line i of meta.jsonl; workers keep only line offsets and read hit rows on demand
+_mem = {"loaded": False, "vecs": None, "cap": 0, "offsets": array("q"), "keys": set(), "meta_size": 0}
+_mem_lock = threading.Lock()
+
+def embed_text(text, dim=MEMORY_DIM):
+    """Signed feature hashing of unigrams + bigrams, L2-normalised. crc32 keeps it stable across processes."""
+    toks = [t for t in _MEM_TOKEN.findall((text or "").lower()) if t not in _MEM_STOP]
+    v = np.zeros(dim, dtype=np.float32)
+    for f in toks + [a + " " + b for a, b in zip(toks, toks[1:])]:
+        h = zlib.crc32(f.encode("utf-8"))
+        v[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+def _memory_paths():
+    return os.path.join(MEMORY_DIR, "vectors.f32"), os.path.join(MEMORY_DIR, "meta.jsonl")
+
+def _memory_map(cap):
+    vec_p, _ = _memory_paths()
+    _mem["cap"]  = cap
+    _mem["vecs"] = np.memmap(vec_p, dtype=np.float32, mode="r+", shape=(cap, MEMORY_DIM)) if cap else None
+
+def _memory_sync():
+    """Load the index on first use, then pick up rows appended since (e.g. by another worker)."""
+    vec_p, meta_p = _memory_paths()
+    if not _mem["loaded"]:
+        os.makedirs(MEMORY_DIR, exist_ok=True)
+        _mem["loaded"] = True
+    size = os.path.getsize(meta_p) if os.path.exists(meta_p) else 0
+    if size > _mem["meta_size"]:
+        with open(meta_p, "rb") as f:
+            f.seek(_mem["meta_size"])
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # half-written trailing line
+                _mem["offsets"].append(_mem["meta_size"])  # row i is line i, even when the line is damaged
+                try:
+                    _mem["keys"].add(json.loads(line).get("key"))
+                except (ValueError, AttributeError):
+                    pass
+                _mem["meta_size"] += len(line)
+    cap = os.path.getsize(vec_p) // (4 * MEMORY_DIM) if os.path.exists(vec_p) else 0
+    if cap != _mem["cap"]:
+        _mem["vecs"] = None
+        _memory_map(cap)
+
+def _memory_rows(idx):
+    """Meta records for row indices `idx`, read straight from meta.jsonl."""
+    out = {}
+    with open(_memory_paths()[1], "rb") as f:
+        for i in sorted(set(idx)):
+            f.seek(_mem["offsets"][i])
+            try:
+                rec = json.loads(f.readline())
+            except ValueError:
+                rec = None
+            out[i] = rec if isinstance(rec, dict) else {}  # damaged line: its row is never returned
+    return out
+
+def memory_add(key, user_text, reply):
+    """Index one logged exchange (called right after log_unified)."""
+    if not MEMORY_ENABLED or np is None or not (user_text and reply):
+        return False
+    try:
+        os.makedirs(MEMORY_DIR, exist_ok=True)
+        with _mem_lock, host_lock(os.path.join(MEMORY_DIR, ".lock")):
+            _memory_sync()
+            if key in _mem["keys"]:
+                return False
+            n = len(_mem["offsets"])
+            if n >= _mem["cap"]:
+                cap = max(1024, _mem["cap"] * 2)
+                _mem["vecs"] = None
+                with open(_memory_paths()[0], "ab") as f:
+                    f.truncate(cap * 4 * MEMORY_DIM)
+                _memory_map(cap)
+            _mem["vecs"][n] = embed_text(f"{user_text}\n{reply}")
+            _mem["vecs"].flush()
+            line = (json.dumps({"key": key, "user": user_text[:500], "kai": reply[:500]}) + "\n").encode("utf-8")
+            with open(_memory_paths()[1], "ab") as f:
+                f.write(line)
+            _mem["offsets"].append(_mem["meta_size"])
+            _mem["keys"].add(key)
+            _mem["meta_size"] += len(line)
+        return True
+    except Exception as e:
+        print("memory_add warn:", e)
+        return False
+
+def memory_search(query, k=MEMORY_TOP_K, min_sim=MEMORY_MIN_SIM, exclude=()):
+    """Top-k past exchanges by cosine similarity: [{key, user, kai, score}]. `exclude` skips user texts already in the prompt."""
+    if not MEMORY_ENABLED or np is None or k <= 0:
+        return []
+    try:
+        q = embed_text(query)
+        if not q.any():
+            return []
+        with _mem_lock:
+            _memory_sync()
+            n = len(_mem["offsets"])
+            if not n:
+                return []
+            scores = _mem["vecs"][:n] @ q
+            want = min(n, k + len(exclude))
+            idx = np.argpartition(-scores, want - 1)[:want] if want < n else np.arange(n)
+            idx = [i for i in idx[np.argsort(-scores[idx])] if scores[i] >= min_sim]
+            meta = _memory_rows(idx)
+        out = []
+        for i in idx:
+            if not meta[i] or meta[i].get("user") in exclude:
+                continue
+            out.append({**meta[i], "score": round(float(scores[i]), 3)})
+            if len(out) >= k:
+                break
+        return out
+    except Exception as e:
+        print("memory_search warn:", e)
+        return []
+
+def fit_context(history, memories, budget=PROMPT_CONTEXT_CHARS):
+    """Trim history lines (oldest first) and then memories (lowest rank first) to `budget` chars."""
+    if budget <= 0:
+        return history, memories
+    kept, used = [], 0
+    for line in reversed(history):
+        if kept and used + len(line) + 1 > budget:
+            break
+        kept.append(line)
+        used += len(line) + 1
+    mems = []
+    for m in memories:
+        n = len(build_memory_context([m])) + 2
+        if used + n > budget:
+            break
+        mems.append(m)
+        used += n
+    return kept[::-1], mems
+
+def build_memory_context(memories):
+    lines = [f"User: {(m.get('user') or '')[:300]}\nKai: {(m.get('kai') or '')[:300]}" for m in memories]
+    return "\n\n".join(lines)
+
+@app.get("/memory_search")
+@require_api_key
+def memory_search_route():
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"status":"error","error":"missing q"}), 400
+    t0 = time.perf_counter()
+    hits = memory_search(q, k=int(request.args.get("k", MEMORY_TOP_K)), min_sim=float(request.args.get("min_sim", 0)))
+    return jsonify({"status":"success", "hits": hits, "size": len(_mem["offsets"]),
+                    "elapsed_ms": round((time.perf_counter()-t0)*1000, 2)})
+
+def memory_index_cli(argv):
+    import argparse
+    ap = argparse.ArgumentParser(prog="server.py memory-index", description="Index past unified_log turns into long-term memory.")
+    ap.add_argument("--file", help="local unified_log export (JSON) instead of Firebase")
+    ap.add_argument("--since", help="only index log keys >= this prefix")
+    args = ap.parse_args(argv)
+    if np is None:
+        raise SystemExit("numpy not installed")
+    if args.file:
+        with open(args.file) as f:
+            logs = json.load(f) or {}
+        logs = logs.get("unified_log", logs)
+    else:
+        logs = fetch_unified_log(since=args.since)
+    added = 0
+    for k in sorted(logs):
+        if args.since and k < args.since:
+            continue
+        item = logs[k] or {}
+        if item.get("user_input") and item.get("content") and item.get("actual_deltas") is not None:
+            added += memory_add(k, item["user_input"], item["content"])
+    print(json.dumps({"added": added, "size": len(_mem["offsets"]), "dir": MEMORY_DIR}))
+
 # ---------- Chat ----------
+def fetch_history(ctx_turns, timeout=6, deadline=None):
+    """Last `ctx_turns` unified_log entries as "User: …" / "Kai: …" lines."""
+    history = []
+    try:
+        q = f'{FB_ROOT}/unified_log.json?orderBy="$key"&limitToLast={max(10, ctx_turns)}'
+        r = requests.get(q, timeout=stage_timeout(deadline, timeout))
+        if r.status_code==200 and r.text and r.text!="null":
+            logs = r.json() or {}
+            for k in sorted(logs.keys())[-ctx_turns:]:
+                item = logs[k] or {}
+                if item.get("user_input"): history.append(f"User: {item.get('user_input')}")
+                if item.get("content"):    history.append(f"Kai: {item.get('content')}")
+    except Exception as e:
+        print("history warn:", e)
+    return history
+
+def route_message(user_text, deadline=None):
+    """
+    Native live intents + web search for one message.
+    Returns dict(decision_debug, live_used, live_text, web_used, web_context, direct_reply, shed);
+    direct_reply is set when no model call is needed (time, headline lists).
+    """
+    route = {
+        "decision_debug": {"matched_time": False, "matched_weather": False, "web_triggered": False},
+        "live_used": None, "live_text": "", "web_used": False, "web_context": "", "direct_reply": None,
+        "shed": [],
+    }
+    decision_debug = route["decision_debug"]
+    intent = classify_intent(user_text)
+    decision_debug["intent"] = intent["intent"]
+
+    # ---- Native live intents (time/weather) ----
+    if intent["action"] == "time":
+        decision_debug["matched_time"] = True
+        route["live_used"] = "time"
+        route["live_text"] = _current_time_payload(user_text, deadline, intent["place"])
+        # Short-circuit TIME replies so the model can't override
+        if route["live_text"]:
+            route["direct_reply"] = route["live_text"]
+        return route
+    if intent["action"] == "weather":
+        decision_debug["matched_weather"] = True
+        route["live_used"] = "weather"
+        route["live_text"] = _current_weather_payload(user_text, deadline, intent["place"])
+        return route
+
+    # ---- Web search for news/other live topics ----
+    if intent["search"]:
+        if intent["action"] == "headlines":
+            snippets, cse_diag = google_cse(user_text, num=5, date_restrict="d1", deadline=deadline)
+            decision_debug["web_triggered"] = True
+            route["web_used"] = True
+            if snippets:
+                lines = []
+                for i, it in enumerate(snippets[:5], 1):
+                    title = (it.get("title") or "").strip()
+                    domain = (it.get("displayLink") or "").strip()
+                    if title:
+                        lines.append(f"{i}. {title}" + (f" — {domain}" if domain else ""))
+                route["direct_reply"] = "Here are some current headlines:\n" + ("\n".join(lines) if lines else "No headlines found.")
+            else:
+                hint = cse_diag.get("error") or "unknown error"
+                route["direct_reply"] = ("I couldn’t fetch fresh headlines right now.\n\n"
+                         f"• Google CSE said: {hint}\n"
+                         "• Check the JSON API is enabled & billing active; use a server key "
+                         "without HTTP referrer restrictions; and make sure the engine searches the web.")
+            return route
+
+        # Otherwise pass snippets as WEB CONTEXT for grounded Q&A (optional: shed when short on budget)
+        if remaining_ms(deadline) < SHED_WEB_BELOW_MS:
+            route["shed"].append("web")
+            return route
+        snippets, _diag = google_cse(user_text, num=5, date_restrict="d1", deadline=deadline)
+        decision_debug["web_triggered"] = bool(snippets)
+        route["web_context"] = build_web_context(snippets)
+        route["web_used"] = bool(route["web_context"])
+    return route
+
+def build_system_prompt(persona_summary, user_summary, history, route, memories=()):
+    # Prefer web context for time-sensitive facts; include live chunk for weather
+    system_prompt = (
+        "You are Kai: warm, witty, emotionally attuned.\n"
+        "Answer concisely and helpfully. If WEB CONTEXT is provided, **treat it as the source of truth** "
+        "for time-sensitive or factual claims and cite as [1], [2], etc. If not relevant, ignore it.\n\n"
+        f"{persona_summary}\n{user_summary}\n"
+    )
+    history, memories = fit_context(history[-20:], list(memories))
+    if memories:
+        system_prompt += "Relevant earlier exchanges (long-term memory):\n" + build_memory_context(memories) + "\n\n"
+    system_prompt += "Conversation so far:\n" + "\n".join(history)
+    if route["web_context"]:
+        system_prompt += "\n\n--- WEB CONTEXT START ---\n" + route["web_context"] + "\n--- WEB CONTEXT END ---\n"
+    if route["live_used"] and route["live_text"]:  # weather path (time already short-circuited)
+        system_prompt += f"\n\n--- LIVE DATA ({route['live_used'].upper()}) ---\n{route['live_text']}\n--- END LIVE DATA ---\n"
+    return system_prompt
+
+def model_reply(user_text, model, system_prompt, live_text="", deadline=None):
+    try:
+        resp = _openai_chat_with_retry(
+            model=model,
+            messages=[{"role":"system","content":system_prompt},
+                      {"role":"user","content":user_text}],
+            timeout=40,
+            deadline=deadline,
+        )
+        reply = (resp.choices[0].message.content or "").strip()
+    except Exception as e:
+        print("openai fatal:", e)
+        reply = live_text or "Temporary hiccup on my side. Try again?"
+    if not reply:
+        reply = live_text or "I’m here—network was flaky for a moment. Try again?"
+    return reply
+
+def apply_deltas(persona, mood, persona_delta, mood_delta):
+    """Clamp tagger deltas and apply them in place; returns the deltas actually applied."""
+    actual_deltas = {}
+    for t in PERSONALITY_TRAITS:
+        d = clamp(int(persona_delta.get(t,0)),-10,10)
+        persona[t] = clamp(persona[t]+d, 0, 1000); actual_deltas[t]=d
+    for t in MOOD_TRAITS:
+        d = clamp(int(mood_delta.get(t,0)),-5,5)
+        mood[t] = clamp(mood[t]+d, 0, 100); actual_deltas[t]=d
+    return actual_deltas
+
+def profile_summary(persona, mood):
+    labels = get_all_labels(persona, mood)
+    mbti   = calculate_mbti(persona)
+    summary = f"MBTI: {mbti}. Personality: " + \
+              ", ".join([f"{k}: {labels['personality_labels'][k]}" for k in PERSONALITY_TRAITS]) + \
+              ". Mood: " + ", ".join([f"{k}: {labels['mood_labels'][k]}" for k in MOOD_TRAITS]) + "."
+    return labels, mbti, summary
+
+def synthesize_tts(text, timeout=25, deadline=None):
+    """ElevenLabs MP3 as base64 ("" when disabled/failed); also refreshes AUDIO_PATH for /get-audio."""
+    if not ELEVEN_API_KEY:
+        return ""
+    try:
+        tts_resp = requests.post(
+            f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}",
+            headers={"xi-api-key": ELEVEN_API_KEY, "Content-Type":"application/json"},
+            json={"text": text, "model_id": ELEVEN_MODEL_ID, "voice_settings": ELEVEN_VOICE_SETTINGS},
+            timeout=stage_timeout(deadline, timeout),
+        )
+        if tts_resp.status_code == 200:
+            save_audio(tts_resp.content)
+            return base64.b64encode(tts_resp.content).decode("utf-8")
+    except Exception as e:
+        print("TTS warn:", e)
+    return ""
+
+def _tag_in_background(log_key, entry, reply):
+    """Shed tagger: score the reply after responding, apply deltas to the live profile and rewrite the log entry."""
+    def run():
+        try:
+            tags_result   = get_tags_persona(reply) or {}
+            persona_delta = tags_result.get("persona_delta",{}) or {}
+            mood_delta    = tags_result.get("mood_delta",{}) or {}
+            persona, mood = fetch_live_profile("agent","Kai")
+            actual_deltas = apply_deltas(persona, mood, persona_delta, mood_delta)
+            labels, mbti, summary = profile_summary(persona, mood)
+            entry.update({
+                "tags": tags_result.get("tags",[]) or [], "persona_delta": persona_delta, "mood_delta": mood_delta,
+                "actual_deltas": actual_deltas, "context": tags_result.get("context_intensity","normal"),
+                "mbti": mbti, "profile": persona, "mood": mood, "labels": labels, "profile_summary": summary,
+            })
+            log_unified(entry, key=log_key)
+            write_profile("agent","Kai", persona, mood,
+                          summary_payload={"summary":summary,"mbti":mbti,"labels":labels})
+        except Exception as e:
+            print("background tagger warn:", e)
+    threading.Thread(target=run, name="tagger", daemon=True).start()
+
+def _direct_response(reply, kai_persona, kai_mood, route):
+    return {
+        "status":"success",
+        "kai_response": reply,
+        "kai_mbti": calculate_mbti(kai_persona),
+        "kai_profile": kai_persona,
+        "kai_mood": kai_mood,
+        "kai_summary": "",
+        "tags": [],
+        "tts_base64": "",
+        "persona_delta": {},
+        "mood_delta": {},
+        "actual_deltas": {},
+        "web_used": route["web_used"],
+        "live_used": route["live_used"],
+        "decision_debug": route["decision_debug"],
+    }
+
 @app.route("/chat", methods=["POST","OPTIONS"])
 @require_api_key
 def chat_text():
     try:
+        t0 = time.monotonic()
         data = request.get_json(force=True) or {}
         user_text = (data.get("text") or "").strip()
         if not user_text:
@@ -618,176 +1826,73 @@ def chat_text():
         actor_id   = "Kai" if actor_type=="agent" else "Darc"
         model      = data.get("model", OPENAI_CHAT_MODEL)
         adapt_user = bool(data.get("adapt_user", False))
-        ctx_turns  = int(data.get("ctx_turns", 20))
+        ctx_turns  = int(data.get("ctx_turns", CTX_TURNS_DEFAULT))
+        budget_ms  = int(data["deadline_ms"]) if data.get("deadline_ms") is not None else CHAT_DEADLINE_MS
+        deadline   = make_deadline(budget_ms)
+        work_deadline = make_deadline(budget_ms - min(PERSIST_RESERVE_MS, budget_ms // 2))
 
         ts_user = datetime.now().strftime("%Y%m%dT%H%M%S")
         log_unified({"user_input": user_text, "source": source, "timestamp": ts_user},
                     key=f"{ts_user}-{source}-USER")
 
-        kai_persona, kai_mood   = fetch_live_profile("agent","Kai")
-        user_persona, user_mood = fetch_live_profile("user","Darc")
+        kai_persona, kai_mood   = fetch_live_profile("agent","Kai", work_deadline)
+        user_persona, user_mood = fetch_live_profile("user","Darc", work_deadline)
 
         # Build short text history
-        history = []
-        try:
-            q = f'{FB_ROOT}/unified_log.json?orderBy="$key"&limitToLast={max(10, ctx_turns)}'
-            r = requests.get(q, timeout=6)
-            if r.status_code==200 and r.text and r.text!="null":
-                logs = r.json() or {}
-                for k in sorted(logs.keys())[-ctx_turns:]:
-                    item = logs[k] or {}
-                    if item.get("user_input"): history.append(f"User: {item.get('user_input')}")
-                    if item.get("content"):    history.append(f"Kai: {item.get('content')}")
-        except Exception as e:
-            print("history warn:", e)
+        history = fetch_history(ctx_turns, deadline=work_deadline)
 
         persona_summary = f"Kai MBTI guess: {calculate_mbti(kai_persona)}. Personality={kai_persona}. Mood={kai_mood}."
         user_summary    = f"User personality={user_persona}. User mood={user_mood}." if adapt_user else ""
 
-        # ---- Decision debug (to see what fired) ----
-        decision_debug = {"matched_time": False, "matched_weather": False, "web_triggered": False}
-
-        # ---- Native live intents (time/weather) ----
-        live_used = None
-        live_text = ""
-        if _TIMEY.search(user_text):
-            decision_debug["matched_time"] = True
-            live_used = "time"
-            live_text = _current_time_payload(user_text)
-        elif _WEATHERY.search(user_text):
-            decision_debug["matched_weather"] = True
-            live_used = "weather"
-            live_text = _current_weather_payload(user_text)
-
-        # --- Short-circuit TIME replies so the model can't override ---
-        if live_used == "time" and live_text:
+        # ---- Native live intents + web search (decision_debug shows what fired) ----
+        route = route_message(user_text, work_deadline)
+        decision_debug = route["decision_debug"]
+        live_used, live_text = route["live_used"], route["live_text"]
+        web_used = route["web_used"]
+        shed = route["shed"]
+        decision_debug.update({"budget_ms": budget_ms or None, "shed": shed})
+
+        if route["direct_reply"]:
+            decision_debug["elapsed_ms"] = int((time.monotonic() - t0) * 1000)
             ts = datetime.now().strftime("%Y%m%dT%H%M%S")
             log_unified({
-                "user_input": user_text, "content": live_text,
-                "timestamp": ts, "web_used": False, "live_used": live_used,
+                "user_input": user_text, "content": route["direct_reply"],
+                "timestamp": ts, "web_used": web_used, "live_used": live_used,
                 "decision_debug": decision_debug,
             }, key=f"{ts}-{source}-Kai")
-            return jsonify({
-                "status":"success",
-                "kai_response": live_text,
-                "kai_mbti": calculate_mbti(kai_persona),
-                "kai_profile": kai_persona,
-                "kai_mood": kai_mood,
-                "kai_summary": "",
-                "tags": [],
-                "tts_base64": "",
-                "persona_delta": {},
-                "mood_delta": {},
-                "actual_deltas": {},
-                "web_used": False,
-                "live_used": live_used,
-                "decision_debug": decision_debug,
-            })
+            return jsonify(_direct_response(route["direct_reply"], kai_persona, kai_mood, route))
 
-        # ---- Web search for news/other live topics ----
-        web_used = False
-        web_context = ""
-        if not live_used and should_search(user_text):
-            headlineish = re.search(r"(?i)\b(news|headlines|breaking|top stories|latest)\b", user_text) is not None
-            if headlineish:
-                snippets, cse_diag = google_cse(user_text, num=5, date_restrict="d1")
-                decision_debug["web_triggered"] = True
-                web_used = True
-                if snippets:
-                    lines = []
-                    for i, it in enumerate(snippets[:5], 1):
-                        title = (it.get("title") or "").strip()
-                        domain = (it.get("displayLink") or "").strip()
-                        if title:
-                            lines.append(f"{i}. {title}" + (f" — {domain}" if domain else ""))
-                    reply = "Here are some current headlines:\n" + ("\n".join(lines) if lines else "No headlines found.")
-                else:
-                    hint = cse_diag.get("error") or "unknown error"
-                    reply = ("I couldn’t fetch fresh headlines right now.\n\n"
-                             f"• Google CSE said: {hint}\n"
-                             "• Check the JSON API is enabled & billing active; use a server key "
-                             "without HTTP referrer restrictions; and make sure the engine searches the web.")
-                ts = datetime.now().strftime("%Y%m%dT%H%M%S")
-                log_unified({
-                    "user_input": user_text, "content": reply,
-                    "timestamp": ts, "web_used": web_used, "live_used": None,
-                    "decision_debug": decision_debug,
-                }, key=f"{ts}-{source}-Kai")
-                return jsonify({
-                    "status": "success",
-                    "kai_response": reply,
-                    "kai_mbti": calculate_mbti(kai_persona),
-                    "kai_profile": kai_persona,
-                    "kai_mood": kai_mood,
-                    "kai_summary": "",
-                    "tags": [],
-                    "tts_base64": "",
-                    "persona_delta": {},
-                    "mood_delta": {},
-                    "actual_deltas": {},
-                    "web_used": web_used,
-                    "live_used": None,
-                    "decision_debug": decision_debug,
-                })
-
-            # Otherwise pass snippets as WEB CONTEXT for grounded Q&A
-            snippets, _diag = google_cse(user_text, num=5, date_restrict="d1")
-            decision_debug["web_triggered"] = bool(snippets)
-            web_context = build_web_context(snippets)
-            web_used = bool(web_context)
-
-        # System prompt (prefer web context for time-sensitive facts; include live chunk for weather)
-        system_prompt = (
-            "You are Kai: warm, witty, emotionally attuned.\n"
-            "Answer concisely and helpfully. If WEB CONTEXT is provided, **treat it as the source of truth** "
-            "for time-sensitive or factual claims and cite as [1], [2], etc. If not relevant, ignore it.\n\n"
-            f"{persona_summary}\n{user_summary}\n"
-            "Conversation so far:\n" + "\n".join(history[-20:])
-        )
-        if web_context:
-            system_prompt += "\n\n--- WEB CONTEXT START ---\n" + web_context + "\n--- WEB CONTEXT END ---\n"
-        if live_used and live_text:  # weather path (time already short-circuited)
-            system_prompt += f"\n\n--- LIVE DATA ({live_used.upper()}) ---\n{live_text}\n--- END LIVE DATA ---\n"
+        # Long-term memory: a few relevant older exchanges beyond the ctx_turns window
+        recent_inputs = {h[len("User: "):] for h in history if h.startswith("User: ")}
+        memories = memory_search(user_text, exclude=recent_inputs)
+        decision_debug["memory_hits"] = len(memories)
 
         # Call OpenAI
-        try:
-            resp = _openai_chat_with_retry(
-                model=model,
-                messages=[{"role":"system","content":system_prompt},
-                          {"role":"user","content":user_text}],
-                timeout=40,
-            )
-            reply = (resp.choices[0].message.content or "").strip()
-        except Exception as e:
-            print("openai fatal:", e)
-            reply = live_text or "Temporary hiccup on my side. Try again?"
-
-        if not reply:
-            reply = live_text or "I’m here—network was flaky for a moment. Try again?"
-
-        # Tag & update persona/mood
-        tags_result   = get_tags_persona(reply) or {}
+        system_prompt = build_system_prompt(persona_summary, user_summary, history, route, memories)
+        reply = model_reply(user_text, model, system_prompt, live_text, work_deadline)
+
+        # Tag & update persona/mood (optional: shed to a background thread when short on budget)
+        tagger_shed = remaining_ms(work_deadline) < SHED_TAGGER_BELOW_MS
+        if tagger_shed:
+            shed.append("tagger")
+        tags_result   = {} if tagger_shed else (get_tags_persona(reply, work_deadline) or {})
         persona_delta = tags_result.get("persona_delta",{}) or {}
         mood_delta    = tags_result.get("mood_delta",{}) or {}
         tags          = tags_result.get("tags",[]) or []
         context       = tags_result.get("context_intensity","normal")
 
-        actual_deltas = {}
-        for t in PERSONALITY_TRAITS:
-            d = clamp(int(persona_delta.get(t,0)),-10,10)
-            kai_persona[t] = clamp(kai_persona[t]+d, 0, 1000); actual_deltas[t]=d
-        for t in MOOD_TRAITS:
-            d = clamp(int(mood_delta.get(t,0)),-5,5)
-            kai_mood[t] = clamp(kai_mood[t]+d, 0, 100); actual_deltas[t]=d
+        actual_deltas = apply_deltas(kai_persona, kai_mood, persona_delta, mood_delta)
+        labels, mbti, summary = profile_summary(kai_persona, kai_mood)
 
-        labels = get_all_labels(kai_persona, kai_mood)
-        mbti   = calculate_mbti(kai_persona)
-        summary = f"MBTI: {mbti}. Personality: " + \
-                  ", ".join([f"{k}: {labels['personality_labels'][k]}" for k in PERSONALITY_TRAITS]) + \
-                  ". Mood: " + ", ".join([f"{k}: {labels['mood_labels'][k]}" for k in MOOD_TRAITS]) + "."
+        # TTS (optional: shed when short on budget; the client can still call /tts). Decided
+        # before logging so the entry's decision_debug records it.
+        want_tts = CHAT_TTS_DEFAULT and bool(ELEVEN_API_KEY)
+        if want_tts and remaining_ms(work_deadline) < SHED_TTS_BELOW_MS:  # what's left after the reserved writes
+            shed.append("tts")
+            want_tts = False
 
         ts = datetime.now().strftime("%Y%m%dT%H%M%S")
-        log_unified({
+        entry = {
             "user_input": user_text, "content": reply, "tags": tags,
             "persona_delta": persona_delta, "mood_delta": mood_delta,
             "actual_deltas": actual_deltas, "context": context, "timestamp": ts,
@@ -795,27 +1900,18 @@ def chat_text():
             "labels": labels, "profile_summary": summary,
             "web_used": web_used, "live_used": live_used,
             "decision_debug": decision_debug,
-        }, key=f"{ts}-{source}-Kai")
+        }
+        log_key = log_unified(entry, key=f"{ts}-{source}-Kai")
+        memory_add(log_key, user_text, reply)
 
-        write_profile("agent","Kai", kai_persona, kai_mood,
-                      summary_payload={"summary":summary,"mbti":mbti,"labels":labels})
+        if tagger_shed:
+            _tag_in_background(log_key, dict(entry, profile=dict(kai_persona), mood=dict(kai_mood)), reply)
+        else:
+            write_profile("agent","Kai", kai_persona, kai_mood,
+                          summary_payload={"summary":summary,"mbti":mbti,"labels":labels})
 
-        # TTS (optional)
-        tts_b64 = ""
-        if CHAT_TTS_DEFAULT and ELEVEN_API_KEY:
-            try:
-                tts_resp = requests.post(
-                    f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}",
-                    headers={"xi-api-key": ELEVEN_API_KEY, "Content-Type":"application/json"},
-                    json={"text": reply, "model_id": ELEVEN_MODEL_ID, "voice_settings": ELEVEN_VOICE_SETTINGS},
-                    timeout=25,
-                )
-                if tts_resp.status_code == 200:
-                    with open("/tmp/audio.mp3","wb") as f:
-                        f.write(tts_resp.content)
-                    tts_b64 = base64.b64encode(tts_resp.content).decode("utf-8")
-            except Exception as e:
-                print("TTS warn:", e)
+        tts_b64 = synthesize_tts(reply, deadline=deadline) if want_tts else ""
+        decision_debug["elapsed_ms"] = int((time.monotonic() - t0) * 1000)
 
         return jsonify({
             "status":"success",
@@ -837,6 +1933,355 @@ def chat_text():
         traceback.print_exc()
         return jsonify({"status":"error","error":str(e)}), 500
 
+# ---------- Batch chat (offline replay) ----------
+CHAT_BATCH_MAX         = int(os.getenv("CHAT_BATCH_MAX", "50"))
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+_LOG_TS = re.compile(r"\d{8}T\d{6}")
+
+def _log_timestamp(value, default):
+    """Client timestamp as a log-key-safe %Y%m%dT%H%M%S (ISO 8601 is converted to local time); `default` otherwise."""
+    if not isinstance(value, str):
+        return default
+    value = value.strip()
+    if _LOG_TS.fullmatch(value):
+        return value
+    try:
+        dt = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith(("Z", "z")) else value)
+    except ValueError:
+        return default
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.strftime("%Y%m%dT%H%M%S")
+
+@app.route("/chat_batch", methods=["POST","OPTIONS"])
+@require_api_key
+def chat_batch():
+    """
+    Replay queued messages for one actor in order:
+      {"messages": ["hi", {"text": "...", "timestamp": "20250101T120000"}, ...], "source": "app", ...}
+    Timestamps may also be ISO 8601. Log keys never go backwards: a missing/bad or earlier timestamp
+    takes the previous message's (the first valid one, else server time, for leading messages).
+    State + history are loaded once; routing/OpenAI/tagger run with bounded concurrency
+    (each prompt sees the stored history plus the earlier queued user messages, not their replies);
+    deltas are applied in order and every log entry + the final profile go out in one write_batch().
+    TTS is only generated for the last model reply (opt out with "tts": false).
+    If that write fails the response is a 502 (replies included) so the client keeps its queue.
+    """
+    try:
+        data = request.get_json(force=True) or {}
+        raw = data.get("messages")
+        if not isinstance(raw, list) or not raw:
+            return jsonify({"status":"error","error":"Missing 'messages'"}), 400
+        if len(raw) > CHAT_BATCH_MAX:
+            return jsonify({"status":"error","error":f"Too many messages (max {CHAT_BATCH_MAX})"}), 400
+
+        msgs = []
+        for m in raw:
+            if isinstance(m, dict):
+                text = m.get("text")
+                msgs.append(((text if isinstance(text, str) else "").strip(), m.get("timestamp")))
+            else:
+                msgs.append(((str(m) if m is not None else "").strip(), None))
+        if not all(t for t, _ in msgs):
+            return jsonify({"status":"error","error":"Every message needs 'text'"}), 400
+
+        source     = data.get("source","app")
+        model      = data.get("model", OPENAI_CHAT_MODEL)
+        adapt_user = bool(data.get("adapt_user", False))
+        ctx_turns  = int(data.get("ctx_turns", CTX_TURNS_DEFAULT))
+        want_tts   = CHAT_TTS_DEFAULT and bool(data.get("tts", True))
+
+        kai_persona, kai_mood   = fetch_live_profile("agent","Kai")
+        user_persona, user_mood = fetch_live_profile("user","Darc") if adapt_user else ({}, {})
+        history = fetch_history(ctx_turns)
+
+        persona_summary = f"Kai MBTI guess: {calculate_mbti(kai_persona)}. Personality={kai_persona}. Mood={kai_mood}."
+        user_summary    = f"User personality={user_persona}. User mood={user_mood}." if adapt_user else ""
+
+        def _one(i):
+            user_text = msgs[i][0]
+            route = route_message(user_text)
+            if route["direct_reply"]:
+                return route, route["direct_reply"], None
+            prior = history + [f"User: {t}" for t, _ in msgs[:i]]
+            memories = memory_search(user_text, exclude={h[len("User: "):] for h in prior if h.startswith("User: ")})
+            route["decision_debug"]["memory_hits"] = len(memories)
+            reply = model_reply(user_text, model, build_system_prompt(persona_summary, user_summary, prior, route, memories),
+                                route["live_text"])
+            return route, reply, (get_tags_persona(reply) or {})
+
+        with ThreadPoolExecutor(max_workers=max(1, min(CHAT_BATCH_CONCURRENCY, len(msgs)))) as pool:
+            outcomes = list(pool.map(_one, range(len(msgs))))
+
+        # Apply deltas strictly in message order
+        updates, results = {}, []
+        stamps = [_log_timestamp(ts, None) for _, ts in msgs]
+        prev = next((ts for ts in stamps if ts), datetime.now().strftime("%Y%m%dT%H%M%S"))
+        last_model_reply = None
+        for i, ((user_text, _), (route, reply, tags_result)) in enumerate(zip(msgs, outcomes)):
+            # Keys follow message order, the order deltas are applied in (history/replay read $key order)
+            ts_user = prev = max(stamps[i] or prev, prev)
+            # a/b suffixes keep each USER entry ahead of its reply in $key order
+            updates[f"unified_log/{ts_user}-{source}-b{i:03d}a-USER"] = {
+                "user_input": user_text, "source": source, "timestamp": ts_user}
+            key = f"unified_log/{ts_user}-{source}-b{i:03d}b-Kai"
+            if tags_result is None:
+                updates[key] = {
+                    "user_input": user_text, "content": reply,
+                    "timestamp": ts_user, "web_used": route["web_used"], "live_used": route["live_used"],
+                    "decision_debug": route["decision_debug"],
+                }
+                results.append(_direct_response(reply, dict(kai_persona), dict(kai_mood), route))
+                continue
+
+            persona_delta = tags_result.get("persona_delta",{}) or {}
+            mood_delta    = tags_result.get("mood_delta",{}) or {}
+            tags          = tags_result.get("tags",[]) or []
+            actual_deltas = apply_deltas(kai_persona, kai_mood, persona_delta, mood_delta)
+            labels, mbti, summary = profile_summary(kai_persona, kai_mood)
+            updates[key] = {
+                "user_input": user_text, "content": reply, "tags": tags,
+                "persona_delta": persona_delta, "mood_delta": mood_delta,
+                "actual_deltas": actual_deltas, "context": tags_result.get("context_intensity","normal"),
+                "timestamp": ts_user, "mbti": mbti, "profile": dict(kai_persona), "mood": dict(kai_mood),
+                "labels": labels, "profile_summary": summary,
+                "web_used": route["web_used"], "live_used": route["live_used"],
+                "decision_debug": route["decision_debug"],
+            }
+            last_model_reply = len(results)
+            results.append({
+                "status":"success",
+                "kai_response": reply,
+                "kai_mbti": mbti,
+                "kai_profile": dict(kai_persona),
+                "kai_mood": dict(kai_mood),
+                "kai_summary": summary,
+                "tags": tags,
+                "tts_base64": "",
+                "persona_delta": persona_delta,
+                "mood_delta": mood_delta,
+                "actual_deltas": actual_deltas,
+                "web_used": route["web_used"],
+                "live_used": route["live_used"],
+                "decision_debug": route["decision_debug"],
+            })
+
+        labels, mbti, summary = profile_summary(kai_persona, kai_mood)
+        if last_model_reply is not None:
+            updates.update(profile_paths("agent","Kai", kai_persona, kai_mood,
+                                         summary_payload={"summary":summary,"mbti":mbti,"labels":labels}))
+        persisted = write_batch(updates)
+        if persisted:
+            for k in sorted(updates):
+                item = updates[k]
+                if k.startswith("unified_log/") and item.get("actual_deltas") is not None:
+                    memory_add(k[len("unified_log/"):], item["user_input"], item["content"])
+
+        if not persisted:
+            return jsonify({
+                "status":"error",
+                "error":"Failed to persist batch; keep the queue and retry",
+                "persisted": False,
+                "count": len(results),
+                "results": results,
+            }), 502
+
+        if want_tts and last_model_reply is not None:
+            results[last_model_reply]["tts_base64"] = synthesize_tts(results[last_model_reply]["kai_response"])
+
+        return jsonify({
+            "status":"success",
+            "count": len(results),
+            "results": results,
+            "persisted": persisted,
+            "kai_mbti": mbti,
+            "kai_profile": kai_persona,
+            "kai_mood": kai_mood,
+            "kai_summary": summary,
+        })
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"status":"error","error":str(e)}), 500
+
+# ---------- Replay engine (rebuild persona/mood from unified_log) ----------
+REPLAY_TRAITS = PERSONALITY_TRAITS + MOOD_TRAITS
+
+def fetch_unified_log(since=None, timeout=30):
+    q = f'{FB_ROOT}/unified_log.json?orderBy="$key"'
+    if since:
+        q += f'&startAt="{since}"'
+    r = requests.get(q, timeout=timeout)
+    r.raise_for_status()
+    return r.json() or {}
+
+def log_delta_matrix(logs):
+    """(keys, timestamps, deltas[n, len(REPLAY_TRAITS)]) for log entries carrying actual_deltas, in key order."""
+    keys, stamps, rows = [], [], []
+    for k in sorted(logs):
+        item = logs[k] or {}
+        ad = item.get("actual_deltas")
+        if not ad:
+            continue
+        keys.append(k)
+        stamps.append(item.get("timestamp"))
+        rows.append([int(ad.get(t, 0) or 0) for t in REPLAY_TRAITS])
+    deltas = np.array(rows, dtype=np.int64).reshape(len(rows), len(REPLAY_TRAITS))
+    return keys, stamps, deltas
+
+def _clamped_cumsum(start, deltas, lo, hi):
+    """
+    x[t] = clamp(x[t-1] + deltas[t], lo, hi) for every column at once.
+    Each step is the map x -> clamp(x + a, l, h); these compose into the same form
+    (a1+a2, clamp(l1+a2, l2, h2), clamp(h1+a2, l2, h2)), so a log-depth prefix scan
+    over (a, l, h) gives the whole trajectory without a Python loop over rows.
+    """
+    a = deltas.astype(np.int64, copy=True)
+    l = np.full_like(a, lo)
+    h = np.full_like(a, hi)
+    shift = 1
+    while shift < len(a):
+        a2, l2, h2 = a[shift:], l[shift:], h[shift:]
+        new_a = a[:-shift] + a2
+        new_l = np.clip(l[:-shift] + a2, l2, h2)
+        new_h = np.clip(h[:-shift] + a2, l2, h2)
+        a[shift:], l[shift:], h[shift:] = new_a, new_l, new_h
+        shift *= 2
+    return np.clip(np.asarray(start, dtype=np.int64) + a, l, h)
+
+def replay_trajectory(deltas, start=None):
+    """Persona (n,4) and mood (n,6) after each logged turn, same clamping as chat_text()."""
+    start = start or get_center_values()
+    n_p = len(PERSONALITY_TRAITS)
+    p0 = [int(start["personality"][t]) for t in PERSONALITY_TRAITS]
+    m0 = [int(start["mood"][t]) for t in MOOD_TRAITS]
+    persona = _clamped_cumsum(p0, np.clip(deltas[:, :n_p], -10, 10), 0, 1000)
+    mood    = _clamped_cumsum(m0, np.clip(deltas[:, n_p:], -5, 5), 0, 100)
+    return persona, mood
+
+def _rolling_stats(x, window):
+    """Trailing mean/std per column; the first window-1 rows use the partial window."""
+    n = len(x)
+    c  = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(x, axis=0, dtype=np.float64)])
+    c2 = np.vstack([np.zeros((1, x.shape[1])), np.cumsum(x.astype(np.float64) ** 2, axis=0)])
+    hi = np.arange(1, n + 1)
+    lo = np.maximum(0, hi - max(1, window))
+    cnt = (hi - lo)[:, None]
+    mean = (c[hi] - c[lo]) / cnt
+    var  = (c2[hi] - c2[lo]) / cnt - mean ** 2
+    return mean, np.sqrt(np.maximum(var, 0))
+
+def replay_series(persona, mood, window=20):
+    """Derived series: MBTI per turn, bucket_index() labels and rolling trait statistics."""
+    letters = np.array([["I","E"], ["S","N"], ["T","F"], ["J","P"]])
+    mbti_chars = letters[np.arange(len(PERSONALITY_TRAITS)), (persona >= 500).astype(np.int64)]
+    p_buckets = np.minimum(9, persona * 10 // 1000)
+    m_buckets = np.minimum(9, mood * 10 // 100)
+    values = np.hstack([persona, mood])
+    mean, std = _rolling_stats(values, window)
+    labels = {t: np.array(PERSONALITY_LABELS[t])[p_buckets[:, j]].tolist() for j, t in enumerate(PERSONALITY_TRAITS)}
+    labels.update({t: np.array(MOOD_LABELS[t])[m_buckets[:, j]].tolist() for j, t in enumerate(MOOD_TRAITS)})
+    return {
+        "mbti": ["".join(r) for r in mbti_chars],
+        "values": {t: values[:, j].tolist() for j, t in enumerate(REPLAY_TRAITS)},
+        "labels": labels,
+        "rolling_mean": {t: np.round(mean[:, j], 2).tolist() for j, t in enumerate(REPLAY_TRAITS)},
+        "rolling_std":  {t: np.round(std[:, j], 2).tolist() for j, t in enumerate(REPLAY_TRAITS)},
+    }
+
+def run_replay(logs, start=None, window=20, include_series=False, step=1):
+    """Recompute Kai's state from unified_log entries; shared by /replay_state and `python server.py replay`."""
+    t0 = time.perf_counter()
+    keys, stamps, deltas = log_delta_matrix(logs)
+    t1 = time.perf_counter()
+    persona, mood = replay_trajectory(deltas, start)
+    series = replay_series(persona, mood, window) if include_series and len(keys) else None
+    t2 = time.perf_counter()
+
+    start = start or get_center_values()
+    final_p = {t: int(persona[-1, j]) for j, t in enumerate(PERSONALITY_TRAITS)} if len(keys) else dict(start["personality"])
+    final_m = {t: int(mood[-1, j]) for j, t in enumerate(MOOD_TRAITS)} if len(keys) else dict(start["mood"])
+    labels, mbti, summary = profile_summary(final_p, final_m)
+
+    # Compare against the snapshot the last logged turn recorded
+    last = (logs.get(keys[-1]) or {}) if keys else {}
+    recorded = {**(last.get("profile") or {}), **(last.get("mood") or {})}
+    drift = {t: int(recorded[t]) - v for t, v in {**final_p, **final_m}.items() if t in recorded and recorded[t] != v}
+
+    out = {
+        "count": len(keys),
+        "first_key": keys[0] if keys else None,
+        "last_key": keys[-1] if keys else None,
+        "personality_current": final_p,
+        "mood_current": final_m,
+        "mbti": mbti,
+        "labels": labels,
+        "summary": summary,
+        "drift": drift,
+        "elapsed_ms": {"parse": round((t1-t0)*1000, 2), "replay": round((t2-t1)*1000, 2)},
+    }
+    if series:
+        step = max(1, int(step))
+        sl = slice(None, None, step)
+        out["series"] = {
+            "keys": keys[sl], "timestamps": stamps[sl], "mbti": series["mbti"][sl],
+            **{name: {t: vals[sl] for t, vals in series[name].items()}
+               for name in ("values", "labels", "rolling_mean", "rolling_std")},
+        }
+    return out
+
+@app.route("/replay_state", methods=["GET","POST","OPTIONS"])
+@require_api_key
+def replay_state():
+    """
+    Rebuild Kai's persona/mood by replaying unified_log actual_deltas from the center values.
+    Query/body: since (log key prefix), window (rolling stats), series=1, step (downsample series),
+    start ({personality, mood} to replay from). POST with apply=1 writes the result via write_profile().
+    """
+    try:
+        if np is None:
+            return jsonify({"status":"error","error":"numpy not installed"}), 500
+        data = (request.get_json(silent=True) or {}) if request.method == "POST" else {}
+        arg = lambda k, d=None: data.get(k, request.args.get(k, d))
+        logs = fetch_unified_log(since=arg("since"))
+        out = run_replay(logs, start=data.get("start"), window=int(arg("window", 20)),
+                         include_series=str(arg("series", "0")) in ("1", "true", "True"),
+                         step=int(arg("step", 1)))
+        applied = False
+        if request.method == "POST" and str(arg("apply", "0")) in ("1", "true", "True"):
+            write_profile("agent","Kai", out["personality_current"], out["mood_current"],
+                          summary_payload={"summary":out["summary"],"mbti":out["mbti"],"labels":out["labels"]})
+            applied = True
+        return jsonify({"status":"success", "applied": applied, **out})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"status":"error","error":str(e)}), 500
+
+def replay_cli(argv):
+    import argparse
+    ap = argparse.ArgumentParser(prog="server.py replay", description="Recompute Kai's persona/mood from unified_log.")
+    ap.add_argument("--file", help="local unified_log export (JSON) instead of Firebase")
+    ap.add_argument("--since", help="only replay log keys >= this prefix")
+    ap.add_argument("--window", type=int, default=20)
+    ap.add_argument("--series", action="store_true", help="include per-turn series in the output")
+    ap.add_argument("--step", type=int, default=1)
+    ap.add_argument("--apply", action="store_true", help="write the recomputed state with write_profile()")
+    args = ap.parse_args(argv)
+    if np is None:
+        raise SystemExit("numpy not installed")
+    if args.file:
+        with open(args.file) as f:
+            logs = json.load(f) or {}
+        logs = logs.get("unified_log", logs)
+        if args.since:
+            logs = {k: v for k, v in logs.items() if k >= args.since}
+    else:
+        logs = fetch_unified_log(since=args.since)
+    out = run_replay(logs, window=args.window, include_series=args.series, step=args.step)
+    if args.apply:
+        write_profile("agent","Kai", out["personality_current"], out["mood_current"],
+                      summary_payload={"summary":out["summary"],"mbti":out["mbti"],"labels":out["labels"]})
+    print(json.dumps(out, indent=2))
+
 # ---------- diag ----------
 @app.route("/diag", methods=["GET"])
 def diag():
@@ -849,10 +2294,28 @@ def diag():
             "GOOGLE_API_KEY_set": bool(GOOGLE_API_KEY),
             "GOOGLE_CSE_ID_set": bool(GOOGLE_CSE_ID),
             "ELEVEN_API_KEY_set": bool(ELEVEN_API_KEY),
-        }
+            "SHARED_CACHE_PATH": SHARED_CACHE_PATH,
+            "ADMIN_KEY_VALUE_set": bool(ADMIN_KEY_VALUE),
+            "PROFILE_SLOWEST": PROFILE_SLOWEST,
+        },
+        "pid": os.getpid(),
     })
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["replay"]:
+        replay_cli(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ["memory-index"]:
+        memory_index_cli(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ["bench-router"]:
+        bench_router_cli(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ["serve"]:
+        # Production: N pre-forked gunicorn workers sharing SHARED_CACHE_PATH (see gunicorn.conf.py)
+        here = os.path.dirname(os.path.abspath(__file__))
+        os.execvp("gunicorn", ["gunicorn", "-c", os.path.join(here, "gunicorn.conf.py"),
+                               "--chdir", here, *sys.argv[2:], "server:app"])
     port = int(os.environ.get("PORT", 5000))
     print(f"Starting Flask on 0.0.0.0:{port}")
     app.run(host="0.0.0.0", port=port)
\ No newline at end of file